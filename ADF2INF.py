@@ -18,7 +18,8 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 
-import os, string, sys
+import getopt, glob, json, multiprocessing, os, string, StringIO, sys, time
+import traceback
 import ADFSlib
 
 try:
@@ -28,7 +29,6 @@ try:
 
 except ImportError:
 
-    import getopt
     use_getopt = 1
 
 
@@ -36,6 +36,55 @@ __version__ = "0.42 (Sun 29th August 2010)"
 
 default_convert_dict = {"/": "."}
 
+# The suffixes of files that are treated as disc images when directories
+# are searched in batch mode.
+image_suffixes = (".adf", ".ads", ".adm", ".adl", ".hdf")
+
+batch_syntax = "(-b | --batch) [(-j jobs) | --jobs=number] [-l] [-d] [-t] " + \
+               "[-s separator] [-v] [-c characters] [-m] [-a format] " + \
+               "[-D store] [-S] [-J file] <ADF files, directories or patterns>... " + \
+               "<destination path>"
+
+
+def write_stats_text(stats):
+
+    # Print the timings and counters recorded while reading a disc to the
+    # standard error stream in case the standard output is being used for
+    # an archive.
+    keys = stats.keys()
+    keys.sort()
+    
+    for key in keys:
+    
+        value = stats[key]
+        
+        if key[-5:] == " time":
+            sys.stderr.write("%-22s %.6f\n" % (key + ":", value))
+        else:
+            sys.stderr.write("%-22s %i\n" % (key + ":", value))
+
+
+def write_stats_json(value, stats_file):
+
+    try:
+        f = open(stats_file, "w")
+        json.dump(value, f, indent = 4, sort_keys = True)
+        f.write("\n")
+        f.close()
+    except IOError:
+        sys.stderr.write("Couldn't write the statistics file: %s\n" % stats_file)
+
+
+def report_stats(adfsdisc, print_stats, stats_file):
+
+    # Print the timings and counters recorded while reading the disc and
+    # write them to a file in JSON format if requested.
+    if print_stats:
+        write_stats_text(adfsdisc.stats)
+    
+    if stats_file is not None:
+        write_stats_json(adfsdisc.stats, stats_file)
+
 
 def read_cmdsyntax_input(argv, syntax):
 
@@ -63,12 +112,13 @@ def read_cmdsyntax_input(argv, syntax):
 
 def read_getopt_input(argv):
 
-    opts, args = getopt.getopt(argv[1:], "ldts:c:vh")
+    opts, args = getopt.getopt(argv[1:], "ldts:c:va:D:SJ:h")
     
     match = {}
     
     opt_dict = {"-l": "list", "-d": "create-directory", "-t": "file-types", "-s": "separator",
-                "-v": "verify", "-c": "convert", "-h": "help"}
+                "-v": "verify", "-c": "convert", "-a": "archive", "-D": "store",
+                "-S": "stats", "-J": "stats-json", "-h": "help"}
     arg_list = ["ADF file", "destination path"]
     
     # Read the options specified.
@@ -119,20 +169,360 @@ def read_getopt_input(argv):
     return match
 
 
+def read_batch_input(argv):
+
+    # Batch mode options are always read with getopt because any number of
+    # images can be given.
+    long_opts = ["batch", "jobs=", "list", "create-directory", "file-types",
+                 "separator=", "verify", "convert=", "time-stamps", "archive=",
+                 "store=", "stats", "stats-json=", "help"]
+    
+    try:
+        opts, args = getopt.getopt(argv[1:], "bj:ldts:vc:ma:D:SJ:h", long_opts)
+    except getopt.GetoptError:
+        return None
+    
+    match = {}
+    
+    opt_dict = {"-b": "batch", "-j": "jobs", "-l": "list",
+                "-d": "create-directory", "-t": "file-types", "-s": "separator",
+                "-v": "verify", "-c": "convert", "-m": "time-stamps",
+                "-a": "archive", "-D": "store", "-S": "stats", "-J": "stats-json",
+                "-h": "help"}
+    
+    for opt, value in opts:
+    
+        if opt_dict.has_key(opt):
+            match[opt_dict[opt]] = value or '1'
+        else:
+            match[opt[2:]] = value or '1'
+    
+    if match.has_key("help"):
+    
+        return None
+    
+    elif match.has_key("list") or match.has_key("verify"):
+    
+        # For list and verify operations, all the arguments are images.
+        if len(args) < 1:
+            return None
+        
+        match["ADF files"] = args
+    
+    else:
+    
+        # For all other operations, the last argument is the destination.
+        if len(args) < 2:
+            return None
+        
+        match["ADF files"] = args[:-1]
+        match["destination path"] = args[-1]
+    
+    return match
+
+
+def find_images(sources):
+
+    # Return the paths of the images given by a list of files, directories
+    # and glob patterns. Directories are searched for files with the usual
+    # disc image suffixes.
+    images = []
+    
+    for source in sources:
+    
+        if os.path.isdir(source):
+        
+            found = []
+            
+            for dir_path, dir_names, file_names in os.walk(source):
+            
+                for file_name in file_names:
+                
+                    suffix = os.path.splitext(file_name)[1]
+                    
+                    if string.lower(suffix) in image_suffixes:
+                        found.append(os.path.join(dir_path, file_name))
+            
+            found.sort()
+            images = images + found
+        
+        elif glob.has_magic(source):
+        
+            found = glob.glob(source)
+            found.sort()
+            images = images + found
+        
+        else:
+        
+            # Pass other paths on so that missing files are reported.
+            images.append(source)
+    
+    return images
+
+
+def image_destinations(images, out_path):
+
+    # Give each image its own destination, named after the image file,
+    # within the output path.
+    destinations = []
+    used = {}
+    
+    for image in images:
+    
+        name = os.path.splitext(os.path.basename(image))[0]
+        
+        if used.has_key(name):
+        
+            used[name] = used[name] + 1
+            name = "%s-%i" % (name, used[name])
+        
+        else:
+        
+            used[name] = 1
+        
+        destinations.append(os.path.join(out_path, name))
+    
+    return destinations
+
+
+def process_image(arguments):
+
+    # Read, list, verify or extract a single image in batch mode, returning
+    # the path of the image, a result of "ok", "unrecognised" or "failed",
+    # the reason for any failure, the text that would have been printed, the
+    # time taken, the statistics recorded for the disc and the content store
+    # used to extract its files, if any.
+    adf_file, out_path, options = arguments
+    
+    start = time.time()
+    stdout = sys.stdout
+    sys.stdout = output = StringIO.StringIO()
+    stats = None
+    reason = None
+    store = None
+    
+    try:
+    
+        adf = open(adf_file, "rb")
+        
+        try:
+        
+            adfsdisc = ADFSlib.ADFSdisc(
+                adf, verify = options["listing"] or options["verify"]
+                )
+            stats = adfsdisc.stats
+            
+            if options["listing"]:
+            
+                print 'Contents of', adfsdisc.disc_name,':'
+                print
+                
+                adfsdisc.print_catalogue(adfsdisc.files, adfsdisc.root_name,
+                                         options["filetypes"])
+                
+                print
+                
+                adfsdisc.print_log()
+            
+            elif options["verify"]:
+            
+                adfsdisc.print_log(verbose = 1)
+            
+            elif options["archive format"] is not None:
+            
+                if options["use name"]:
+                    archive_path = adfsdisc.disc_name
+                else:
+                    archive_path = ""
+                
+                archive = open(out_path + "." + options["archive format"], "wb")
+                
+                try:
+                    adfsdisc.extract_to_archive(
+                        archive, options["archive format"], adfsdisc.files,
+                        options["filetypes"], options["separator"],
+                        options["convert dict"], archive_path
+                        )
+                finally:
+                    archive.close()
+            
+            else:
+            
+                if options["use name"]:
+                    out_path = os.path.join(out_path, adfsdisc.disc_name)
+                
+                # Each image has its own store object, even when the images
+                # are processed in the same process, but they all share the
+                # same store directory, and their counts are merged later.
+                if options["store"] is not None:
+                    store = ADFSlib.ADFScontentStore(options["store"])
+                
+                adfsdisc.extract_files(
+                    out_path, adfsdisc.files, options["filetypes"],
+                    options["separator"], options["convert dict"],
+                    options["with time stamps"], store = store
+                    )
+            
+            result = "ok"
+        
+        finally:
+        
+            adf.close()
+    
+    except ADFSlib.ADFS_exception, e:
+    
+        if stats is None:
+            print "Unrecognised disc image: %s" % adf_file
+            result = "unrecognised"
+        else:
+            print e
+            result = "failed"
+            reason = str(e)
+    
+    except (IOError, OSError), e:
+    
+        print "Couldn't process %s: %s" % (adf_file, e)
+        result = "failed"
+        reason = str(e)
+    
+    except Exception, e:
+    
+        # Damaged images can cause errors anywhere in the library, so record
+        # them rather than letting them stop the rest of the batch.
+        print "Couldn't process %s:" % adf_file
+        print traceback.format_exc()
+        result = "failed"
+        reason = "%s: %s" % (e.__class__.__name__, e)
+    
+    finally:
+    
+        sys.stdout = stdout
+    
+    return (adf_file, result, reason, output.getvalue(), time.time() - start,
+            stats, store)
+
+
+def run_batch(images, out_path, options, jobs, print_stats, stats_file):
+
+    # Process the images, in a pool of worker processes if more than one job
+    # is requested, printing the output for each image in the order that
+    # the images were given followed by a summary, including the totals for
+    # the content store if one was used. Returns the number of images that
+    # could not be processed.
+    if out_path is None:
+        destinations = [None] * len(images)
+    else:
+        destinations = image_destinations(images, out_path)
+    
+    tasks = map(lambda image, destination: (image, destination, options),
+                images, destinations)
+    
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+    
+    start = time.time()
+    
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(process_image, tasks)
+    else:
+        pool = None
+        results = map(process_image, tasks)
+    
+    counts = {"ok": 0, "unrecognised": 0, "failed": 0}
+    problems = []
+    all_stats = {}
+    slowest = None
+    all_stores = None
+    
+    for adf_file, result, reason, output, elapsed, stats, store in results:
+    
+        sys.stdout.write(output)
+        counts[result] = counts[result] + 1
+        
+        if result != "ok":
+            problems.append((result, adf_file, reason))
+        
+        if slowest is None or elapsed > slowest[0]:
+            slowest = (elapsed, adf_file)
+        
+        if stats is not None:
+        
+            all_stats[adf_file] = stats
+            
+            if print_stats:
+                sys.stderr.write("%s:\n" % adf_file)
+                write_stats_text(stats)
+        
+        if store is not None:
+        
+            # Combine the counts for the images so that contents found in
+            # more than one image are only counted once.
+            if all_stores is None:
+                all_stores = ADFSlib.ADFScontentStore(options["store"])
+            
+            all_stores.merge(store)
+    
+    if pool is not None:
+        pool.close()
+        pool.join()
+    
+    elapsed = time.time() - start
+    
+    if stats_file is not None:
+        write_stats_json(all_stats, stats_file)
+    
+    print
+    print "Processed %i images in %.2f seconds using %i jobs." % (
+        len(images), elapsed, jobs)
+    print "Succeeded: %i  Unrecognised: %i  Failed: %i" % (
+        counts["ok"], counts["unrecognised"], counts["failed"])
+    
+    for result, adf_file, reason in problems:
+    
+        if reason is None:
+            print "  %s: %s" % (result, adf_file)
+        else:
+            print "  %s: %s (%s)" % (result, adf_file, reason)
+    
+    if slowest is not None:
+        print "Slowest image: %s (%.3f seconds)" % (slowest[1], slowest[0])
+    
+    if all_stores is not None:
+        print
+        print "Content store: %s" % options["store"]
+        print all_stores.report()
+    
+    return len(problems)
+
+
 if __name__ == "__main__":
     
-    if use_getopt == 0:
+    batch = "-b" in sys.argv[1:] or "--batch" in sys.argv[1:]
+    
+    if batch:
+    
+        syntax = batch_syntax
+        match = read_batch_input(sys.argv)
+    
+    elif use_getopt == 0:
     
         syntax = """
-        \r( (-l | --list) [-t | --file-types] <ADF file> ) |
+        \r( (-l | --list) [-t | --file-types]
+        \r  [-S | --stats] [(-J stats-json) | --stats-json=file]
+        \r  <ADF file> ) |
         \r
         \r( [-d | --create-directory]
         \r  [ (-t | --file-types) [(-s separator) | --separator=character] ]
         \r  [(-c convert) | --convert=characters]
         \r  [-m | --time-stamps]
+        \r  [(-a archive) | --archive=format]
+        \r  [(-D store) | --store=directory]
+        \r  [-S | --stats] [(-J stats-json) | --stats-json=file]
         \r  <ADF file> <destination path> ) |
         \r
-        \r( (-v | --verify) <ADF file> ) |
+        \r( (-v | --verify) [-S | --stats] [(-J stats-json) | --stats-json=file]
+        \r  <ADF file> ) |
         \r
         \r(-h | --help)
         """
@@ -142,13 +532,16 @@ if __name__ == "__main__":
     else:
     
         syntax = "[-l] [-d] [-t] [-s separator] [-v] [-c characters] [-m] " + \
-                 "<ADF file> <destination path>"
+                 "[-a format] [-D store] [-S] [-J file] <ADF file> " + \
+                 "<destination path>"
         match = read_getopt_input(sys.argv)
     
     if match == {} or match is None or \
         match.has_key("h") or match.has_key("help"):
     
         print "Syntax: ADF2INF.py " + syntax
+        if not batch:
+            print "        ADF2INF.py " + batch_syntax
         print
         print 'ADF2INF version ' + __version__
         print 'ADFSlib version ' + ADFSlib.__version__
@@ -189,6 +582,34 @@ if __name__ == "__main__":
         print "The -m flag determines whether the files extracted from the disc"
         print "image should retain their time stamps on the target system."
         print
+        print "The -a flag causes the files to be written to an archive of the given"
+        print "format, either tar or zip, instead of a directory structure. The"
+        print "destination path is the name of the archive file to create, or - to"
+        print "write the archive to standard output."
+        print
+        print "The -D flag gives the path of a content store directory in which the"
+        print "contents of the extracted files are kept, named after their SHA-1"
+        print "hashes. Each file with the same contents as another is created as a"
+        print "link to the stored copy, so identical files are only stored once, even"
+        print "across many disc images and separate runs. A summary of the files"
+        print "stored is printed after the files are extracted."
+        print
+        print "The -S flag causes the time taken by each phase of reading the disc"
+        print "image, and counts of the work done, to be printed to standard error."
+        print "The -J flag writes the same statistics in JSON format to the file given."
+        print
+        print "The -b flag enables batch mode, in which any number of disc images,"
+        print "directories containing images and glob patterns can be given. Each"
+        print "image is listed, verified or extracted into its own destination,"
+        print "named after the image file, within the destination path, and a"
+        print "summary of the images processed is printed at the end. The -j flag"
+        print "gives the number of images to process at the same time in separate"
+        print "processes, or 0 to use one process per CPU. The -J flag writes the"
+        print "statistics for all the images to one file. If the -D flag is given,"
+        print "all the images share the same content store and the summary includes"
+        print "the deduplication ratio for all the files extracted. The exit status"
+        print "is non-zero if any image could not be processed."
+        print
         sys.exit()
     
     
@@ -201,8 +622,12 @@ if __name__ == "__main__":
     verify = match.has_key("v") or match.has_key("verify")
     convert = match.has_key("c") or match.has_key("convert")
     with_time_stamps = match.has_key("m") or match.has_key("time-stamps")
+    archive_format = match.get("archive", None)
+    store_path = match.get("store", None)
+    print_stats = match.has_key("S") or match.has_key("stats")
+    stats_file = match.get("stats-json", None)
     
-    adf_file = match["ADF file"]
+    adf_file = match.get("ADF file", None)
     
     out_path = match.get("destination path", None)
     
@@ -220,6 +645,56 @@ if __name__ == "__main__":
         separator = suffix
     
     
+    # If a list of conversions was specified then create a dictionary to
+    # pass to the disc object's extraction method.
+    if match.has_key("convert"):
+    
+        convert_dict = {}
+        
+        pairs = string.split(match["convert"])
+        
+        try:
+        
+            for pair in pairs:
+            
+                convert_dict[pair[0]] = pair[1]
+        
+        except IndexError:
+        
+            print "Insufficient characters in character conversion list."
+            sys.exit()
+    
+    else:
+    
+        # Use a default conversion dictionary.
+        convert_dict = default_convert_dict
+    
+    if batch:
+    
+        options = {"listing": listing, "verify": verify, "use name": use_name,
+                   "filetypes": filetypes, "separator": separator,
+                   "convert dict": convert_dict,
+                   "with time stamps": with_time_stamps,
+                   "archive format": archive_format, "store": store_path}
+        
+        try:
+            jobs = int(match.get("jobs", "1"))
+        except ValueError:
+            print "The number of jobs must be an integer."
+            sys.exit()
+        
+        if out_path is not None and not os.path.isdir(out_path):
+            os.makedirs(out_path)
+        
+        problems = run_batch(find_images(match["ADF files"]), out_path,
+                             options, jobs, print_stats, stats_file)
+        
+        # Exit with a non-zero status if any image could not be processed.
+        if problems:
+            sys.exit(1)
+        sys.exit()
+    
+    
     # Try to open the ADFS disc image file.
     
     try:
@@ -273,6 +748,8 @@ if __name__ == "__main__":
         
         adfsdisc.print_log(verbose = 1)
         
+        report_stats(adfsdisc, print_stats, stats_file)
+        
         # Exit
         sys.exit()
     
@@ -289,6 +766,8 @@ if __name__ == "__main__":
         
         adfsdisc.print_log()
         
+        report_stats(adfsdisc, print_stats, stats_file)
+        
         # Exit
         sys.exit()
     
@@ -296,40 +775,62 @@ if __name__ == "__main__":
     # Make sure that the disc is put in a directory corresponding to the disc
     # name where applicable.
     
-    if use_name != 0:
+    if archive_format is not None:
+    
+        # Place the output files in a directory within the archive.
+        if use_name != 0:
+            archive_path = adfsdisc.disc_name
+        else:
+            archive_path = ""
+    
+    elif use_name != 0:
     
         # Place the output files on this new path.
         out_path = os.path.join(out_path, adfsdisc.disc_name)
     
-    # If a list of conversions was specified then create a dictionary to
-    # pass to the disc object's extraction method.
-    if match.has_key("convert"):
+    if archive_format is not None:
     
-        convert_dict = {}
-        
-        pairs = string.split(match["convert"])
+        # Write the files to an archive.
+        if out_path == "-":
+            archive = sys.stdout
+        else:
+            try:
+                archive = open(out_path, "wb")
+            except IOError:
+                print "Couldn't open the archive file: %s" % out_path
+                sys.exit()
         
         try:
+            adfsdisc.extract_to_archive(
+                archive, archive_format, adfsdisc.files, filetypes, separator,
+                convert_dict, archive_path
+                )
+        except ADFSlib.ADFS_exception, e:
+            sys.stderr.write("%s\n" % e)
         
-            for pair in pairs:
-            
-                convert_dict[pair[0]] = pair[1]
+        if archive != sys.stdout:
+            archive.close()
         
-        except IndexError:
+        report_stats(adfsdisc, print_stats, stats_file)
         
-            print "Insufficient characters in character conversion list."
-            sys.exit()
+        # Exit
+        sys.exit()
     
+    # Extract the files, through a content store if one was given.
+    if store_path is not None:
+        store = ADFSlib.ADFScontentStore(store_path)
     else:
+        store = None
     
-        # Use a default conversion dictionary.
-        convert_dict = default_convert_dict
-    
-    # Extract the files
     adfsdisc.extract_files(
         out_path, adfsdisc.files, filetypes, separator, convert_dict,
-        with_time_stamps
+        with_time_stamps, store = store
         )
     
+    if store is not None:
+        print store.report()
+    
+    report_stats(adfsdisc, print_stats, stats_file)
+    
     # Exit
     sys.exit()
@@ -25,7 +25,8 @@ __version__ = "0.42"
 __license__ = "GNU General Public License (version 3)"
 
 
-import os, string, struct, time
+import array, bisect, errno, hashlib, io, marshal, mmap, multiprocessing.pool
+import os, re, string, struct, tarfile, threading, time, zipfile
 
 
 INFORM = 0
@@ -35,9 +36,117 @@ ERROR = 2
 # Find the number of centiseconds between 1900 and 1970.
 between_epochs = ((365 * 70) + 17) * 24 * 360000L
 
+# The version of the catalogue cache format written by ADFSdisc.
+catalogue_cache_version = 2
+
+# The columns of the table returned by ADFSdisc.catalogue_table and the
+# array type codes used to store them. Names are stored as strings.
+catalogue_columns = (
+    ("path_id", "i"), ("parent_id", "i"), ("name", None),
+    ("load_address", "I"), ("execution_address", "I"), ("length", "I"),
+    ("filetype", "h"), ("is_directory", "B"), ("first_offset", "l")
+    )
+
+# The number of bits in the disc record stored in the first zone of a new
+# style map.
+disc_record_bits = 60 * 8
+
+# Words used to read fragment numbers from new style maps.
+_map_word = struct.Struct("<Q")
+
+# The layout of a directory entry: name, load address, execution address,
+# length, the low and high parts of the disc address, and the attributes
+# or sequence number.
+_directory_entry = struct.Struct("<10sIIIHBB")
+
+# The layout of the fields read from a disc record, from the log2 sector
+# size up to the high byte of the number of zones.
+_disc_record = struct.Struct("<10BHIIH10sIIBBB")
+
+# A pattern used to skip runs of zero bits in new style maps.
+_non_zero = re.compile("[^\x00]")
+
+# A pattern used to find runs of free allocation units in allocation bitmaps.
+_free_run = re.compile("\x00+")
+
+# The position of the lowest set bit in each byte value (8 for zero) and the
+# masks which clear the bits below each bit position in a byte.
+_lowest_bit = [8]
+for _value in range(1, 256):
+    _lowest_bit.append(len(bin(_value & -_value)) - 3)
+
+_bits_from = map(lambda shift: (0xff << shift) & 0xff, range(8))
+
+
+def _safe_table(lower):
+
+    # Return a translation table and a string of characters to delete which
+    # convert the characters in ADFS names to plain ASCII. Characters with
+    # their top bits set are replaced by the corresponding ASCII characters
+    # or deleted if these are not printable, and characters up to the lower
+    # limit, which end names, are replaced by a zero byte.
+    table = []
+    deleted = []
+    
+    for value in range(256):
+    
+        if value <= lower:
+            table.append("\x00")
+        elif value >= 128 and (value ^ 128) <= 32:
+            table.append(chr(value))
+            deleted.append(chr(value))
+        elif value >= 128:
+            table.append(chr(value ^ 128))
+        else:
+            table.append(chr(value))
+    
+    return string.join(table, ""), string.join(deleted, "")
+
+# Tables used to decode names without and with spaces.
+_safe_tables = (_safe_table(32), _safe_table(31))
+
+# Translation tables for character conversion dictionaries, keyed by the
+# sorted items in each dictionary.
+_conversion_tables = {}
+
+# The NumPy module, imported when it is first needed by catalogue_table, or
+# False if it is not available.
+_numpy = None
+
+
+def _import_numpy():
+
+    # Return the NumPy module, or None if it cannot be imported. NumPy is
+    # only imported when a table is requested so that scripts which never
+    # create one do not pay the cost of importing it.
+    global _numpy
+    
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    
+    return _numpy or None
+
+# Images which pass less than this fraction of the checks for a format are
+# not recognised by ADFSprobe.
+min_probe_confidence = 0.5
 
 class Utilities:
 
+    # Statistics are only recorded by instances with a stats dictionary.
+    stats = None
+    
+    # The last character conversion dictionary used and its table.
+    _last_conversion = None
+    
+    def _count(self, key, amount = 1):
+    
+        if self.stats is not None:
+            self.stats[key] = self.stats.get(key, 0) + amount
+    
     # Little endian reading
     
     def _read_signed_word(self, s):
@@ -75,6 +184,16 @@ class Utilities:
         
         return n
     
+    def _record_data(self):
+    
+        # Return the object holding the disc image data from which records
+        # can be unpacked using struct layouts. Memory views are accessed
+        # through an ADFSbufferView, which struct cannot read.
+        if isinstance(self.sectors, ADFSbufferView):
+            return self.sectors.view
+        
+        return self.sectors
+    
     def _binary(self, size, n):
     
         new = ""
@@ -95,25 +214,11 @@ class Utilities:
     
     def _safe(self, s, with_space = 0):
     
-        new = ""
-        if with_space == 1:
-            lower = 31
-        else:
-            lower = 32
-        
-        for i in s:
-        
-            if ord(i) <= lower:
-                break
-            
-            if ord(i) >= 128:
-                c = ord(i)^128
-                if c > 32:
-                    new = new + chr(c)
-            else:
-                new = new + i
+        # Translate the name and remove anything after the character which
+        # ends it.
+        table, deleted = _safe_tables[with_space == 1]
         
-        return new
+        return s.translate(table, deleted).split("\x00", 1)[0]
     
     def _plural(self, msg, values, words):
     
@@ -148,7 +253,46 @@ class Utilities:
         
         return msg % tuple(substitutions)
     
-    def _create_directory(self, path, name = None):
+    def _create_directory(self, path, name = None, known = None):
+    
+        # If a dictionary of known directories is given, it maps the paths
+        # passed to this method, and the paths it returns, to directories that
+        # are known to exist. A directory whose parent is known to exist only
+        # needs to be created.
+        
+        if known is not None and name is None:
+        
+            if known.has_key(path):
+                return known[path]
+            
+            parent, element = os.path.split(path)
+            
+            if known.has_key(parent) and element != '' and element != '$':
+            
+                built = os.path.join(known[parent], element)
+                
+                # Only report the directory if it was created here, not if it
+                # already existed.
+                try:
+                    os.mkdir(built)
+                except OSError:
+                    exists = os.path.isdir(built)
+                else:
+                    print 'Created directory:', built
+                    exists = 1
+                
+                if exists:
+                    known[path] = known[built] = built
+                    return built
+        
+        built = self._make_directories(path, name)
+        
+        if known is not None and name is None and built != "":
+            known[path] = known[built] = built
+        
+        return built
+    
+    def _make_directories(self, path, name = None):
     
         elements = []
         
@@ -203,21 +347,131 @@ class Utilities:
         # Success
         return built
     
+    def _read_directory(self, name, address, reader):
+    
+        # Unless the catalogue is being read lazily, read the directory at
+        # the given address using the reader method supplied.
+        if self.lazy:
+            return ADFSdirectory(name, None, address, reader)
+        
+        lower_dir_name, lower_files = reader(address)
+        return ADFSdirectory(name, lower_files, address)
+    
+    def _read_disc_record(self, offset):
+    
+        """Reads the disc record for D and E format disc images and returns a
+        dictionary describing the disc image.
+        """
+        
+        # See ADFS/DiscRecord.htm for details.
+        
+        (log2_sector_size, nsectors, heads, density, idlen,
+         log2_bytes_per_bit, skew, boot_option, low_sector, zones,
+         zone_spare, root, disc_size, disc_id, disc_name, disc_type,
+         disc_size_high, log2_share_size, big_flag, zones_high) = \
+            _disc_record.unpack_from(self._record_data(), offset)
+        
+        # log2_sector_size is the total sectors per track (sectors * heads),
+        # nsectors the sectors per track and heads the heads per track.
+        
+        if density == 1:
+        
+            density = 'single'        # Single density disc
+        
+        elif density == 2:
+        
+            density = 'double'        # Double density disc
+        
+        elif density == 3:
+        
+            density = 'quad'        # Quad density disc
+        
+        else:
+        
+            density = 'unknown'
+        
+        # idlen is the length of ID fields in the disc map and
+        # log2_bytes_per_bit the number of bytes per map bit.
+        bytes_per_bit = 2 ** log2_bytes_per_bit
+        # The root directory address is held in the top three bytes of its
+        # word.
+        root = root >> 8
+        disc_name = string.strip(disc_name)
+        # The disc size and number of zones have high parts.
+        disc_size = disc_size | (disc_size_high << 32)
+        zones = zones | (zones_high << 8)
+        
+        return {'sectors': nsectors, 'log2 sector size': log2_sector_size,
+            'sector size': 2**log2_sector_size, 'heads': heads,
+            'density': density, 'idlen': idlen,
+            'log2 bytes per bit': log2_bytes_per_bit,
+            'bytes per bit': bytes_per_bit, 'zone spare': zone_spare,
+            'disc size': disc_size, 'disc ID': disc_id,
+            'disc name': disc_name, 'zones': zones, 'root dir': root }
+    
+    def _conversion_table(self, convert_dict):
+    
+        # Return a translation table for the conversion dictionary, or a
+        # pattern matching the characters to convert and a function which
+        # replaces them if some characters are replaced by more or less than
+        # one character. Tables are created
+        # once for each set of conversions, and the table for the dictionary
+        # used last is found without looking it up.
+        last = self._last_conversion
+        
+        if last is not None and last[0] is convert_dict and \
+            last[1] == convert_dict:
+            
+            return last[2]
+        
+        table = self._find_conversion_table(convert_dict)
+        self._last_conversion = (convert_dict, convert_dict.copy(), table)
+        return table
+    
+    def _find_conversion_table(self, convert_dict):
+    
+        key = convert_dict.items()
+        key.sort()
+        key = tuple(key)
+        
+        try:
+            return _conversion_tables[key]
+        except KeyError:
+            pass
+        
+        replacements = map(chr, range(256))
+        converted = []
+        
+        for c, replacement in key:
+        
+            if len(c) == 1:
+                replacements[ord(c)] = replacement
+                converted.append(re.escape(c))
+        
+        if filter(lambda replacement: len(replacement) != 1, replacements):
+        
+            # Only the characters to be converted are found and replaced,
+            # leaving names which contain none of them untouched.
+            pattern = re.compile("[" + string.join(converted, "") + "]")
+            table = (pattern,
+                     lambda match: replacements[ord(match.group())])
+        else:
+            table = string.join(replacements, "")
+        
+        _conversion_tables[key] = table
+        return table
+    
     def _convert_name(self, old_name, convert_dict):
     
         # Use the conversion dictionary to convert any forbidden
         # characters to accepted local substitutes.
-        name = ""
+        table = self._conversion_table(convert_dict)
         
-        for c in old_name:
-        
-            if c in convert_dict.keys():
-            
-                name = name + convert_dict[c]
-            
-            else:
-            
-                name = name + c
+        if isinstance(table, str):
+            name = old_name.translate(table)
+        else:
+            pattern, replace = table
+            name = pattern.sub(replace, old_name)
         
         if self.verify and old_name != name:
         
@@ -234,41 +488,205 @@ class ADFS_exception(Exception):
     pass
 
 
-class ADFSdirectory:
+class ADFSinterleavedImage:
+
+    """image = ADFSinterleavedImage(data, ntracks, track_size)
+    
+    Presents the tracks of an interleaved disc image, stored in the order
+    (0 80 1 81 2 82 ... 79 159) in data, in the logical order
+    (0 1 2 3 ... 159). The data can be any object that supports indexing and
+    slicing, such as a string or a memory map.
+    
+    Single bytes and slices are read from the interleaved data on demand;
+    slices which cross a track boundary are assembled from the pieces in each
+    track.
+    """
+    
+    def __init__(self, data, ntracks, track_size):
+    
+        self.data = data
+        self.ntracks = ntracks
+        self.track_size = track_size
+        self.length = ntracks * track_size
+    
+    def __len__(self):
+    
+        return self.length
+    
+    def _physical_offset(self, offset):
+    
+        # Return the offset into the interleaved data of the given logical
+        # offset.
+        track, offset = divmod(offset, self.track_size)
+        
+        if track < (self.ntracks >> 1):
+            track = track * 2
+        else:
+            track = ((track - (self.ntracks >> 1)) * 2) + 1
+        
+        return (track * self.track_size) + offset
+    
+    def __getitem__(self, index):
+    
+        if isinstance(index, slice):
+        
+            start, stop, step = index.indices(self.length)
+            
+            if step != 1:
+                return string.join(
+                    map(self.__getitem__, range(start, stop, step)), ""
+                    )
+            
+            pieces = []
+            
+            while start < stop:
+            
+                # Read up to the end of the track or the end of the slice.
+                end = min(stop, ((start / self.track_size) + 1) * self.track_size)
+                
+                offset = self._physical_offset(start)
+                pieces.append(self.data[offset:offset + end - start])
+                
+                start = end
+            
+            if len(pieces) == 1:
+                return pieces[0]
+            
+            return string.join(pieces, "")
+        
+        if index < 0:
+            index = index + self.length
+        
+        if index < 0 or index >= self.length:
+            raise IndexError, 'Offset outside the disc image: %i' % index
+        
+        return self.data[self._physical_offset(index)]
+
+
+class ADFSbufferView:
+
+    """image = ADFSbufferView(view)
+    
+    Presents the contents of a memoryview in the same way as a string, so
+    that single bytes and slices are read from it as strings. Only the bytes
+    in each slice are copied from the view.
+    """
+    
+    def __init__(self, view):
+    
+        self.view = view
+    
+    def __len__(self):
+    
+        return len(self.view)
+    
+    def __getitem__(self, index):
+    
+        if isinstance(index, slice):
+            return self.view[index].tobytes()
+        
+        return self.view[index]
+
+
+class ADFSdirectory(object):
 
-    """directory = ADFSdirectory(name, files)
+    """directory = ADFSdirectory(name, files, address = None, reader = None)
     
     The directory created contains name and files attributes containing the
     directory name and the objects it contains.
+    
+    If files is None, the directory's contents are read when the files
+    attribute is first accessed by passing the directory's disc address to
+    the reader function, which returns the directory name and a list of
+    objects.
     """
     
-    def __init__(self, name, files):
+    # Use a fixed set of attributes to reduce the memory used by each object
+    # in large catalogues.
+    __slots__ = ("name", "_files", "address", "reader")
+    
+    def __init__(self, name, files, address = None, reader = None):
     
         self.name = name
-        self.files = files
+        self._files = files
+        self.address = address
+        self.reader = reader
     
     def __repr__(self):
     
         return '<%s instance, "%s", at %x>' % (self.__class__, self.name, id(self))
+    
+    def _get_files(self):
+    
+        if self._files is None:
+        
+            lower_dir_name, self._files = self.reader(self.address)
+            self.reader = None
+        
+        return self._files
+    
+    def _set_files(self, files):
+    
+        self._files = files
+    
+    files = property(_get_files, _set_files)
 
 
-class ADFSfile:
+class ADFSfile(object):
 
-    """file = ADFSfile(name, data, load_address, execution_address, length)
+    """file = ADFSfile(name, data, load_address, execution_address, length,
+                       extents = None, sectors = None, addr = None)
+    
+    If data is None, the file's contents are read from the disc image data,
+    sectors, when the data attribute is first accessed. The extents list
+    contains pairs of (start, end) offsets into the disc image which together
+    hold the file's contents.
+    
+    For files on discs with new style maps, addr holds the System Internal
+    Number (SIN) of the file.
     """
     
-    def __init__(self, name, data, load_address, execution_address, length):
+    # Use a fixed set of attributes to reduce the memory used by each object
+    # in large catalogues.
+    __slots__ = ("name", "_data", "load_address", "execution_address",
+                 "length", "extents", "sectors", "addr")
+    
+    def __init__(self, name, data, load_address, execution_address, length,
+                 extents = None, sectors = None, addr = None):
     
         self.name = name
-        self.data = data
+        self._data = data
         self.load_address = load_address
         self.execution_address = execution_address
         self.length = length
+        self.extents = extents
+        self.sectors = sectors
+        self.addr = addr
     
     def __repr__(self):
     
         return '<%s instance, "%s", at %x>' % (self.__class__, self.name, id(self))
     
+    def _get_data(self):
+    
+        if self._data is None:
+        
+            pieces = []
+            
+            for start, end in self.extents:
+            
+                pieces.append(self.sectors[start:end])
+            
+            self._data = string.join(pieces, "")
+        
+        return self._data
+    
+    def _set_data(self, data):
+    
+        self._data = data
+    
+    data = property(_get_data, _set_data)
+    
     def has_filetype(self):
     
         """Returns True if the file's meta-data contains filetype information."""
@@ -306,258 +724,817 @@ class ADFSfile:
             return ()
 
 
-class ADFSmap(Utilities):
+class ADFSfileStream(io.RawIOBase):
 
-    def __getitem__(self, index):
-    
-        return self.disc_map[index]
-    
-    def has_key(self, key):
+    """stream = ADFSfileStream(file_obj)
     
-        return self.disc_map.has_key(key)
-
-
-class ADFSnewMap(ADFSmap):
-
-    dir_markers = ('Hugo', 'Nick')
-    root_dir_address = 0x800
+    Provides a read-only, seekable file-like object for the contents of the
+    ADFSfile instance, file_obj. The contents are read from the extents of
+    the file in the disc image when they are requested, so the file's data
+    is never assembled in memory unless it has already been read.
+    """
     
-    def __init__(self, header, begin, end, sectors, sector_size, record):
+    def __init__(self, file_obj):
     
-        self.header = header
-        self.begin = begin
-        self.end = end
-        self.sectors = sectors
-        self.sector_size = sector_size
-        self.record = record
+        io.RawIOBase.__init__(self)
         
-        self.free_space = self._read_free_space()
-        self.disc_map = self._read_disc_map()
-    
-    def _read_disc_map(self):
-    
-        # See ADFS/EMaps.htm, ADFS/EFormat.htm and ADFS/DiscMap.htm for details.
+        if file_obj.extents is None or file_obj._data is not None:
         
-        ### TODO: This needs to take into account multiple zones.
+            # The data is already available as a string.
+            self.extents = [(0, len(file_obj.data))]
+            self.sectors = file_obj.data
         
-        disc_map = {}
+        else:
         
-        a = self.begin
+            self.extents = file_obj.extents
+            self.sectors = file_obj.sectors
         
-        current_piece = None
-        current_start = 0
+        # Record the offset within the file of the start of each extent.
+        self.starts = []
+        self.length = 0
         
-        next_zone = self.header + self.sector_size
+        for start, end in self.extents:
         
-        # Copy the free space map.
-        free_space = self.free_space[:]
+            self.starts.append(self.length)
+            self.length = self.length + end - start
         
-        while a < self.end:
+        self.position = 0
+    
+    def readable(self):
+    
+        return True
+    
+    def seekable(self):
+    
+        return True
+    
+    def tell(self):
+    
+        return self.position
+    
+    def seek(self, offset, whence = 0):
+    
+        if whence == 0:
+            position = offset
+        elif whence == 1:
+            position = self.position + offset
+        elif whence == 2:
+            position = self.length + offset
+        else:
+            raise ValueError, "Invalid whence value: %s" % whence
         
-            # The next entry to be read will occur one byte after this one
-            # unless one of the following checks override this behaviour.
-            next = a + 1
-            
-            if (a % self.sector_size) < 4:
-            
-                # In a zone header. Not the first zone header as this
-                # was already skipped when we started reading.
-                next = a + 4 - (a % self.sector_size)
-                
-                # Set the next zone offset.
-                next_zone = next_zone + self.sector_size
-                
-                # Reset the current piece and starting offset.
-                current_piece = None
-                current_start = 0
-            
-            elif free_space != [] and a >= free_space[0][0]:
-            
-                # In the next free space entry. Go to the entry following
-                # it and discard this free space entry.
-                next = free_space[0][1]
-                
-                free_space.pop(0)
-                
-                # Reset the current piece and starting offset.
-                current_piece = None
-                current_start = 0
+        if position < 0:
+            raise IOError, "Cannot seek to a negative position: %i" % position
+        
+        self.position = position
+        return self.position
+    
+    def readinto(self, b):
+    
+        if self.closed:
+            raise ValueError, "I/O operation on closed stream."
+        
+        size = len(b)
+        count = 0
+        
+        while count < size and self.position < self.length:
+        
+            # Find the extent containing the current position and copy as
+            # much of the remainder of it as the buffer can hold.
+            i = bisect.bisect_right(self.starts, self.position) - 1
+            start, end = self.extents[i]
             
-            elif current_piece is None and (next_zone - a) >= 2:
+            offset = start + self.position - self.starts[i]
+            amount = min(size - count, end - offset)
             
-                # If there is enough space left in this zone to allow
-                # further fragments then read the next two bytes.
-                value = self._read_unsigned_half_word(self.sectors[a:a+2])
-                
-                entry = value & 0x7fff
-                
-                # See ADFS/EAddrs.htm document for restriction on
-                # the disc address and hence the file number.
-                # i.e.the top bit of the file number cannot be set.
-                
-                if entry >= 1:
-                
-                    # Defects (1), files or directories (greater than 1)
-                    next = a + 2
-                    
-                    # Define a new entry.
-                    #print "Begin:", hex(entry), hex(a)
-                    
-                    if not disc_map.has_key(entry):
-                    
-                        # Create a new map entry if none exists.
-                        disc_map[entry] = []
-                    
-                    if (value & 0x8000) == 0:
-                    
-                        # Record the file number and start of this fragment.
-                        current_piece = entry
-                        current_start = a
-                    
-                    else:
-                    
-                        # For an immediately terminated fragment, add the
-                        # extents of the block to the list of pieces found
-                        # and implicitly finish reading this fragment
-                        # (current_piece remains None).
-                        
-                        start_addr = self.find_address_from_map(
-                            a, self.begin, entry
-                            )
-                        end_addr = self.find_address_from_map(
-                            next, self.begin, entry
-                            )
-                        
-                        if [start_addr, end_addr] not in disc_map[entry]:
-                        
-                            disc_map[entry].append((start_addr, end_addr))
-                
-                else:
-                
-                    # Search for a valid file number.
-                    # Should probably stop looking in this zone.
-                    next = a + 1
+            # Extents of damaged files can run past the end of the image, so
+            # only copy the data that is actually there, leaving the size of
+            # the buffer unchanged.
+            amount = max(0, min(amount, len(self.sectors) - offset))
+            if amount == 0:
+                break
             
-            elif current_piece is not None:
+            b[count:count + amount] = self.sectors[offset:offset + amount]
             
-                # In a piece being read.
-                
-                value = ord(self.sectors[a])
-                
-                if value == 0:
-                
-                    # Still in the block.
-                    next = a + 1
-                
-                elif value == 0x80:
-                
-                    # At the end of the block.
-                    next = a + 1
-                    
-                    # For relevant entries add the block to the list of
-                    # pieces found.
-                    start_addr = self.find_address_from_map(
-                        current_start, self.begin, current_piece
-                        )
-                    end_addr = self.find_address_from_map(
-                        next, self.begin, current_piece
-                        )
-                    
-                    if [start_addr, end_addr] not in disc_map[current_piece]:
-                    
-                        disc_map[current_piece].append(
-                            (start_addr, end_addr)
-                            )
-                    
-                    # Look for a new fragment.
-                    current_piece = None
-                
-                else:
+            count = count + amount
+            self.position = self.position + amount
+        
+        return count
+
+
+class ADFSarchiveOutput:
+
+    """output = ADFSarchiveOutput(fileobj)
+    
+    Wraps a file object, which need not be seekable, and records the number
+    of bytes written to it so that archive writers can obtain the current
+    position without seeking.
+    """
+    
+    def __init__(self, fileobj):
+    
+        self.fileobj = fileobj
+        self.position = 0
+    
+    def write(self, data):
+    
+        self.fileobj.write(data)
+        self.position = self.position + len(data)
+    
+    def tell(self):
+    
+        return self.position
+    
+    def flush(self):
+    
+        if hasattr(self.fileobj, "flush"):
+            self.fileobj.flush()
+
+
+class ADFStarWriter:
+
+    """writer = ADFStarWriter(fileobj)
+    
+    Writes directories and files to a tar archive as a stream, so the file
+    object does not need to be seekable. The file object is not closed when
+    the writer is closed.
+    """
+    
+    def __init__(self, fileobj):
+    
+        self.archive = tarfile.open(fileobj = fileobj, mode = "w|")
+    
+    def _info(self, name, mtime):
+    
+        # Times before 1970 are not stored reliably in tar archives.
+        info = tarfile.TarInfo(name)
+        info.mtime = max(0, int(mtime))
+        return info
+    
+    def add_directory(self, name, mtime):
+    
+        info = self._info(name, mtime)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0755
+        self.archive.addfile(info)
+    
+    def add_file(self, name, stream, size, mtime):
+    
+        # The contents of the file are copied from the stream in blocks.
+        info = self._info(name, mtime)
+        info.size = size
+        info.mode = 0644
+        self.archive.addfile(info, stream)
+    
+    def close(self):
+    
+        self.archive.close()
+
+
+class ADFSzipWriter:
+
+    """writer = ADFSzipWriter(fileobj)
+    
+    Writes directories and files to a zip archive without seeking, so the
+    file object does not need to be seekable. Each file is compressed in
+    memory before it is written. The file object is not closed when the
+    writer is closed.
+    """
+    
+    def __init__(self, fileobj):
+    
+        self.archive = zipfile.ZipFile(
+            ADFSarchiveOutput(fileobj), "w", zipfile.ZIP_DEFLATED
+            )
+    
+    def _info(self, name, mtime):
+    
+        # Zip archives can only represent times from 1980 to 2107.
+        date_time = max(time.localtime(mtime)[:6], (1980, 1, 1, 0, 0, 0))
+        date_time = min(date_time, (2107, 12, 31, 23, 59, 58))
+        
+        info = zipfile.ZipInfo(name, date_time)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        return info
+    
+    def add_directory(self, name, mtime):
+    
+        info = self._info(name + "/", mtime)
+        info.external_attr = (040755 << 16) | 0x10
+        self.archive.writestr(info, "")
+    
+    def add_file(self, name, stream, size, mtime):
+    
+        info = self._info(name, mtime)
+        info.external_attr = 0644 << 16
+        self.archive.writestr(info, stream.read(size))
+    
+    def close(self):
+    
+        self.archive.close()
+
+
+class ADFScontentStore:
+
+    """store = ADFScontentStore(path, use_links = 1)
+    
+    Stores the contents of extracted files in the directory given by path,
+    identified by the SHA-1 hashes of their contents, so that files with
+    the same contents are only stored once, even across many disc images
+    and separate runs.
+    
+    If use_links is set to True or another non-False value, each extracted
+    file is created as a hard link to the stored copy of its contents, or as
+    a copy if a link cannot be created. Otherwise, no files are created and
+    a reference to the stored contents of each file is recorded in a manifest
+    which can be written with the write_manifest() method.
+    
+    The numbers of files and bytes extracted and stored are recorded in the
+    files, unique, total_bytes and unique_bytes attributes, and a summary
+    is returned by the report() method. Stores can be pickled, so the counts
+    from stores used in other processes can be combined with the merge()
+    method.
+    """
+    
+    def __init__(self, path, use_links = 1):
+    
+        self.path = path
+        self.use_links = use_links
+        
+        self.files = 0
+        self.total_bytes = 0
+        self.unique = 0
+        self.unique_bytes = 0
+        self.written_bytes = 0
+        self.copies = 0
+        
+        self.manifest = []
+        self._seen = {}
+        self._lock = threading.Lock()
+        self._temporary = 0
+    
+    def __getstate__(self):
+    
+        # Locks cannot be pickled, so leave the lock out and create a new one
+        # when the store is unpickled.
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+    
+    def __setstate__(self, state):
+    
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+    
+    def object_path(self, digest):
+    
+        """Returns the path of the stored contents with the given digest."""
+        
+        return os.path.join(self.path, digest[:2], digest)
+    
+    def _temporary_path(self):
+    
+        self._lock.acquire()
+        try:
+            self._temporary = self._temporary + 1
+            name = "tmp-%i-%i" % (os.getpid(), self._temporary)
+        finally:
+            self._lock.release()
+        
+        return os.path.join(self.path, name)
+    
+    def _store(self, stream, stored):
+    
+        # Copy the contents of the stream into the store under the given path,
+        # returning True if they were stored or False if another thread or
+        # process stored the same contents first. The contents are written to
+        # a temporary file which is linked into place, so that readers never
+        # see a partly written object and existing objects are never replaced.
+        directory = os.path.dirname(stored)
+        if not os.path.isdir(directory):
+            try:
+                os.mkdir(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        
+        temporary = self._temporary_path()
+        
+        f = open(temporary, "wb")
+        try:
+            while 1:
+                data = stream.read(65536)
+                if not data:
+                    break
+                f.write(data)
+        finally:
+            f.close()
+        
+        try:
+            os.link(temporary, stored)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            os.remove(temporary)
+            return False
+        except AttributeError:
+        
+            # Rename the file where links are not supported, leaving any
+            # existing object in place.
+            if os.path.exists(stored):
+                os.remove(temporary)
+                return False
+            os.rename(temporary, stored)
+            return True
+        
+        os.remove(temporary)
+        return True
+    
+    def add(self, stream, out_file):
+    
+        """Stores the contents read from the seekable file-like object,
+        stream, unless they are already stored, then creates the file,
+        out_file, with those contents or records a reference to them in the
+        manifest. Returns the digest of the contents.
+        """
+        
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        
+        # Hash the contents before writing anything so that contents which
+        # are already stored are not written again.
+        digest = hashlib.sha1()
+        size = 0
+        
+        while 1:
+            data = stream.read(65536)
+            if not data:
+                break
+            digest.update(data)
+            size = size + len(data)
+        
+        digest = digest.hexdigest()
+        stored = self.object_path(digest)
+        
+        if not os.path.exists(stored):
+        
+            stream.seek(0)
+            if self._store(stream, stored):
+                self._lock.acquire()
+                self.written_bytes = self.written_bytes + size
+                self._lock.release()
+        
+        self._lock.acquire()
+        try:
+        
+            self.files = self.files + 1
+            self.total_bytes = self.total_bytes + size
+            
+            if not self._seen.has_key(digest):
+                self._seen[digest] = size
+                self.unique = self.unique + 1
+                self.unique_bytes = self.unique_bytes + size
+            
+            if not self.use_links:
+                self.manifest.append((digest, size, out_file))
+        
+        finally:
+            self._lock.release()
+        
+        if self.use_links:
+        
+            if os.path.lexists(out_file):
+                os.remove(out_file)
+            
+            try:
+                os.link(stored, out_file)
+            except (AttributeError, OSError):
+            
+                # Copy the contents if links are not supported.
+                f = open(stored, "rb")
+                out = open(out_file, "wb")
+                out.write(f.read())
+                out.close()
+                f.close()
                 
-                    # The byte found was unexpected - backtrack to the
-                    # byte after the start of this block and try again.
-                    #print "Backtrack from %s to %s" % (hex(a), hex(current_start+1))
-                    
-                    next = current_start + 1
-                    current_piece = None
+                self._lock.acquire()
+                self.copies = self.copies + 1
+                self._lock.release()
+        
+        return digest
+    
+    def merge(self, other):
+    
+        """Adds the files handled by another store, such as one used by
+        another process, to the counts and manifest of this store. Contents
+        handled by both stores are only counted once."""
+        
+        self._lock.acquire()
+        try:
+        
+            self.files = self.files + other.files
+            self.total_bytes = self.total_bytes + other.total_bytes
+            self.written_bytes = self.written_bytes + other.written_bytes
+            self.copies = self.copies + other.copies
+            self.manifest = self.manifest + other.manifest
             
-            # Move to the next relevant byte.
-            a = next
+            for digest, size in other._seen.items():
+            
+                if not self._seen.has_key(digest):
+                    self._seen[digest] = size
+                    self.unique = self.unique + 1
+                    self.unique_bytes = self.unique_bytes + size
         
-        return disc_map
+        finally:
+            self._lock.release()
     
-    def _read_free_space(self):
+    def write_manifest(self, fileobj):
     
-        free_space = []
+        """Writes a line for each file whose contents are referred to by the
+        store, containing the digest of the contents, their length and the
+        path of the file, separated by tab characters."""
+        
+        for digest, size, out_file in self.manifest:
+            fileobj.write("%s\t%i\t%s\n" % (digest, size, out_file))
+    
+    def report(self):
+    
+        """Returns a string summarising the files handled by the store."""
+        
+        if self.unique_bytes > 0:
+            ratio = float(self.total_bytes) / self.unique_bytes
+        else:
+            ratio = 1.0
+        
+        lines = [
+            "%i files (%i bytes) extracted." % (self.files, self.total_bytes),
+            "%i unique contents (%i bytes), %i bytes newly stored." % (
+                self.unique, self.unique_bytes, self.written_bytes),
+            "Deduplication ratio: %.2f" % ratio
+            ]
+        
+        if self.copies > 0:
+            lines.append("%i files copied instead of linked." % self.copies)
+        
+        return string.join(lines, "\n")
+
+
+class ADFSmap(Utilities):
+
+    def __getitem__(self, index):
+    
+        return self.disc_map[index]
+    
+    def has_key(self, key):
+    
+        return self.disc_map.has_key(key)
+    
+    def allocation_bitmap(self):
+    
+        """Returns a bytearray containing a byte for each allocation unit on
+        the disc, which is 1 if the unit is in use and 0 if it is free. The
+        size of each unit in bytes is given by the unit attribute.
+        """
         
-        a = self.header
+        bitmap = bytearray("\x01") * (self.disc_size / self.unit)
         
-        while a < self.end:
+        for start, end in self.free_space:
         
-            # The next zone starts a sector after this one.
-            next_zone = a + self.sector_size
+            start = start / self.unit
+            end = min(end / self.unit, len(bitmap))
             
-            a = a + 1
+            if start < end:
+                bitmap[start:end] = bytearray(end - start)
+        
+        return bitmap
+    
+    def free_runs(self, bitmap = None):
+    
+        """Returns a pair of arrays containing the start address and length in
+        bytes of each run of free space on the disc, in the order that they
+        occur. Free space fragments which adjoin each other form a single run.
+        The allocation bitmap is used if given; otherwise it is created.
+        """
+        
+        if bitmap is None:
+            bitmap = self.allocation_bitmap()
+        
+        starts = array.array("l")
+        lengths = array.array("l")
+        
+        for match in _free_run.finditer(str(bitmap)):
+        
+            starts.append(match.start() * self.unit)
+            lengths.append((match.end() - match.start()) * self.unit)
+        
+        return starts, lengths
+    
+    def free_run_histogram(self, lengths = None):
+    
+        """Returns an array containing the number of free runs of each size,
+        where the entry at index i counts the runs of at least 2**i and less
+        than 2**(i + 1) allocation units. The run lengths returned by the
+        free_runs method are used if given.
+        """
+        
+        if lengths is None:
+            starts, lengths = self.free_runs()
+        
+        histogram = array.array("l")
+        
+        for length in lengths:
+        
+            size = (length / self.unit).bit_length() - 1
             
-            # Start by reading the offset in bits from the start of the header
-            # of the first item of free space in the map.
-            offset = self._read_unsigned_half_word(self.sectors[a:a+2])
+            if size >= len(histogram):
+                histogram.extend([0] * (size + 1 - len(histogram)))
             
-            # The top bit is apparently always set, so mask it off and convert
-            # the result into bytes. * Not sure if this is the case for
-            # entries in the map. *
-            next = ((offset & 0x7fff) >> 3)
+            histogram[size] = histogram[size] + 1
+        
+        return histogram
+    
+    def fragment_counts(self):
+    
+        """Returns a pair of arrays containing the fragment numbers of the
+        objects on the disc, in ascending order, and the number of pieces
+        each object occupies. Defects and the map itself are not included.
+        Old style maps do not describe the objects on the disc, so both
+        arrays are empty for them.
+        """
+        
+        ids = filter(lambda frag_id: frag_id > 2, self.disc_map.keys())
+        ids.sort()
+        
+        counts = array.array("l")
+        
+        for frag_id in ids:
+            counts.append(len(self.disc_map[frag_id]))
+        
+        return array.array("l", ids), counts
+    
+    def usage(self):
+    
+        """Returns a dictionary describing the use of space on the disc,
+        containing the disc size, the numbers of bytes used and free, the
+        number of free runs and the length of the largest free run in bytes.
+        """
+        
+        starts, lengths = self.free_runs()
+        free = sum(lengths)
+        
+        return {"disc size": self.disc_size, "used": self.disc_size - free,
+                "free": free, "free runs": len(lengths),
+                "largest free": max([0] + list(lengths))}
+
+
+class ADFSbitStream:
+
+    """stream = ADFSbitStream(data)
+    
+    Reads fields of any width up to 56 bits from the little endian bit stream
+    held in the string, data, such as a zone of a new style map, and finds
+    the set bits which end fragments in the stream.
+    """
+    
+    def __init__(self, data):
+    
+        # Pad the data so that a whole word can always be read.
+        self.length = len(data)
+        self.data = data + ("\x00" * _map_word.size)
+    
+    def read(self, bit, width):
+    
+        """Returns the value of the width bits starting at the given bit."""
+        
+        word = _map_word.unpack_from(self.data, bit >> 3)[0]
+        return int((word >> (bit & 7)) & ((1 << width) - 1))
+    
+    def next_set_bit(self, bit, end):
+    
+        """Returns the position of the first set bit at or after the given
+        bit and before end, or None if there is no set bit in that range.
+        """
+        
+        i = bit >> 3
+        
+        if i >= self.length:
+            return None
+        
+        value = ord(self.data[i]) & _bits_from[bit & 7]
+        
+        if value == 0:
+        
+            # Skip any bytes which contain no set bits.
+            match = _non_zero.search(self.data, i + 1, min(self.length, (end + 7) >> 3))
             
-            if next == 0:
+            if match is None:
+                return None
             
-                # No more free space in this zone. Look at the free
-                # space field in the next zone.
-                a = next_zone
-                continue
+            i = match.start()
+            value = ord(self.data[i])
+        
+        found = (i << 3) + _lowest_bit[value]
+        
+        if found >= end:
+            return None
+        
+        return found
+
+
+def _read_zone(data, offset, layout, idlen, log2_bpmb):
+
+    """fragments, free = _read_zone(data, offset, layout, idlen, log2_bpmb)
+    
+    Decodes the zone of a new style map held in the string, data, which
+    starts at the given offset in the disc image, using the zone layout
+    (start bit, end bit, first allocation unit), fragment number length and
+    log2 of the bytes per map bit.
+    
+    Returns a list of (fragment number, start address, end address) tuples
+    for the fragments in the zone and a list of pairs of disc addresses
+    delimiting each free space fragment in the zone.
+    """
+    
+    stream = ADFSbitStream(data)
+    start_bit, end_bit, first_unit = layout
+    
+    # The zone header contains the offset in bits from bit 8 of the zone
+    # to the first free space fragment. Each free space fragment starts
+    # with the offset in bits to the next one.
+    link = stream.read(8, 15)
+    
+    if link != 0:
+        free_link = 8 + link
+    else:
+        free_link = None
+    
+    fragments = []
+    free = []
+    
+    bit = start_bit
+    
+    while bit < end_bit:
+    
+        # Each fragment starts with its fragment number and is followed
+        # by zero bits up to and including a set bit which ends it.
+        frag_id = stream.read(bit, idlen)
+        frag_end = stream.next_set_bit(bit + idlen, end_bit)
+        
+        if frag_end is None:
+        
+            # The fragment is not terminated within the zone.
+            break
+        
+        frag_end = frag_end + 1
+        
+        if bit == free_link:
+        
+            free.append(
+                ((first_unit + bit - start_bit) << log2_bpmb,
+                 (first_unit + frag_end - start_bit) << log2_bpmb)
+                )
             
-            # Update the offset to point to the free space in this zone.
-            a = a + next
+            link = frag_id & 0x7fff
             
-            while a < next_zone:
+            if link != 0:
+                free_link = bit + link
+            else:
+                free_link = None
+        
+        elif frag_id != 0:
+        
+            # Defects (1), the map and root directory (2), files or
+            # directories (greater than 2)
+            fragments.append(
+                (frag_id, (first_unit + bit - start_bit) << log2_bpmb,
+                 (first_unit + frag_end - start_bit) << log2_bpmb)
+                )
+        
+        bit = frag_end
+    
+    return fragments, free
+
+
+class ADFSnewMap(ADFSmap):
+
+    dir_markers = ('Hugo', 'Nick')
+    root_dir_address = 0x800
+    
+    def __init__(self, header, begin, end, sectors, sector_size, record,
+                 decoded = None):
+    
+        """map = ADFSnewMap(header, begin, end, sectors, sector_size, record,
+                            decoded = None)
+        
+        Decodes the new style map which starts at the offset, header, in the
+        string or memory map, sectors, using the disc record, record.
+        
+        If decoded is not None, it contains the free space list and map
+        dictionary from a previous decoding of the same map, so the map is
+        not decoded again.
+        """
+        
+        self.header = header
+        self.begin = begin
+        self.end = end
+        self.sectors = sectors
+        self.sector_size = sector_size
+        self.record = record
+        self.disc_size = record["disc size"]
+        
+        self._read_layout()
+        
+        if decoded is None:
+            self.free_space, self.disc_map = self._read_disc_map()
+        else:
+            self.free_space, self.disc_map = decoded
+    
+    def _read_layout(self):
+    
+        # See ADFS/DiscRecord.htm and ADFS/DiscMap.htm for details.
+        
+        # Read the length of fragment numbers, the number of bytes described
+        # by each bit in the map and the number of zones from the disc record.
+        self.idlen = self.record["idlen"]
+        self.log2_bytes_per_bit = self.record["log2 bytes per bit"]
+        self.unit = 1 << self.log2_bytes_per_bit
+        self.zones = self.record["zones"]
+        
+        if self.zones == 0:
+            self.zones = max(1, (self.end - self.header) / self.sector_size)
+        
+        # Each zone occupies a sector and starts with a four byte header. The
+        # zone spare bits include the header and any unused bits at the end
+        # of the zone.
+        self.zone_bits = (self.sector_size * 8) - self.record["zone spare"]
+        
+        # For each zone, record the first and last bits used for allocation
+        # and the number of the allocation unit described by the first bit.
+        self.zone_layout = []
+        
+        for zone in range(self.zones):
+        
+            if zone == 0:
             
-                # Read the offset to the next free fragment in this zone.
-                offset = self._read_unsigned_half_word(self.sectors[a:a+2])
-                
-                # Convert this to a byte offset.
-                next = ((offset & 0x7fff) >> 3)
-                
-                # Find the end of the free space.
-                b = a + 1
-                
-                while b < next_zone:
-                
-                    c = b + 1
-                    
-                    value = self._read_unsigned_byte(self.sectors[b])
-                    
-                    if (value & 0x80) != 0:
-                    
-                        break
-                    
-                    b = c
-                
-                # Record the offset into the map of this item of free space
-                # and the offset of the byte after it ends.
-                free_space.append((a, c))
-                
-                if next == 0:
-                
-                    break
-                
-                # Move to the next free space entry.
-                a = a + next
+                # The first zone also contains the disc record.
+                self.zone_layout.append(
+                    (32 + disc_record_bits, 32 + self.zone_bits, 0)
+                    )
             
-            # Whether we are at the end of the zone or not, move to the
-            # beginning of the next zone.
-            a = next_zone
+            else:
+            
+                self.zone_layout.append(
+                    (32, 32 + self.zone_bits,
+                     (zone * self.zone_bits) - disc_record_bits)
+                    )
         
-        # Return the free space list.
-        return free_space
+        # The last zone only describes the remainder of the disc.
+        start_bit, end_bit, first_unit = self.zone_layout[-1]
+        
+        units = self.record["disc size"] >> self.log2_bytes_per_bit
+        end_bit = start_bit + units - first_unit
+        
+        self.zone_layout[-1] = (
+            start_bit, max(start_bit, min(end_bit, self.sector_size * 8)),
+            first_unit
+            )
+    
+    def _read_disc_map(self):
+    
+        # See ADFS/EMaps.htm, ADFS/EFormat.htm and ADFS/DiscMap.htm for details.
+        
+        # Returns the free space list and a dictionary mapping fragment
+        # numbers to lists of pairs of disc addresses.
+        
+        free_space = []
+        disc_map = {}
+        
+        # Merge the fragments from each zone in order so that the pieces of
+        # each object are listed in the order they occur on the disc.
+        for fragments, free in map(self._read_zone, range(self.zones)):
+        
+            free_space = free_space + free
+            
+            for frag_id, start_addr, end_addr in fragments:
+            
+                if disc_map.has_key(frag_id):
+                    disc_map[frag_id].append((start_addr, end_addr))
+                else:
+                    disc_map[frag_id] = [(start_addr, end_addr)]
+        
+        return free_space, disc_map
+    
+    def _read_zone(self, zone):
+    
+        offset = self.header + (zone * self.sector_size)
+        
+        return _read_zone(self.sectors[offset:offset + self.sector_size],
+                          offset, self.zone_layout[zone], self.idlen,
+                          self.log2_bytes_per_bit)
     
     def read_catalogue(self, base):
     
@@ -580,26 +1557,22 @@ class ADFSnewMap(ADFSmap):
         
         files = []
         
+        self._count("directories parsed")
+        
+        data = self._record_data()
+        
         while ord(self.sectors[head+p]) != 0:
         
-            old_name = self.sectors[head+p:head+p+10]
-            top_set = 0
-            counter = 1
-            for i in old_name:
-                if (ord(i) & 128) != 0:
-                    top_set = counter
-                counter = counter + 1
+            self._count("entries decoded")
             
-            name = self._safe(self.sectors[head+p:head+p+10])
+            old_name, load, exe, length, sin_low, sin_high, newdiratts = \
+                _directory_entry.unpack_from(data, head + p)
             
-            load = self._read_unsigned_word(self.sectors[head+p+10:head+p+14])
-            exe = self._read_unsigned_word(self.sectors[head+p+14:head+p+18])
-            length = self._read_unsigned_word(self.sectors[head+p+18:head+p+22])
+            name = self._safe(old_name)
             
-            inddiscadd = self._read_new_address(
-                self.sectors[head+p+22:head+p+25]
-                )
-            newdiratts = self._read_unsigned_byte(self.sectors[head+p+25])
+            # The disc address is a SIN (System Internal Number).
+            sin = sin_low | (sin_high << 16)
+            inddiscadd = self._read_new_address(sin)
             
             if inddiscadd == -1:
             
@@ -615,7 +1588,7 @@ class ADFSnewMap(ADFSmap):
                             )
                         self.verify_log.append( (
                             WARNING, "    file details: %x" % \
-                            self._str2num(3, self.sectors[head+p+22:head+p+25])
+                            sin
                             ) )
                         self.verify_log.append(
                             (WARNING, "    atts: %x" % newdiratts)
@@ -634,7 +1607,7 @@ class ADFSnewMap(ADFSmap):
                         self.verify_log.append( (
                             WARNING,
                             "    file details: %x" % \
-                            self._str2num(3, self.sectors[head+p+22:head+p+25])
+                            sin
                             ) )
                         self.verify_log.append(
                             (WARNING, "    atts: %x" % newdiratts)
@@ -656,32 +1629,34 @@ class ADFSnewMap(ADFSmap):
                     for start, end in inddiscadd:
                     
                         # Try to interpret the data at the referenced address
-                        # as a directory.
-                        
-                        lower_dir_name, lower_files = \
-                            self.read_catalogue(start)
+                        # as a directory and store the directory name and
+                        # files found therein.
                         
-                        # Store the directory name and file found therein.
-                        files.append(ADFSdirectory(name, lower_files))
+                        files.append(
+                            self._read_directory(name, start, self.read_catalogue)
+                            )
                 
                 else:
                 
                     # Remember that inddiscadd will be a sequence of
-                    # pairs of addresses.
+                    # pairs of addresses. Record the parts of these that
+                    # contain the file's data so that it can be read later.
                     
-                    file = ""
+                    extents = []
                     remaining = length
                     
                     for start, end in inddiscadd:
                     
+                        if remaining <= 0:
+                            break
+                        
                         amount = min(remaining, end - start)
-                        file = file + self.sectors[start : (start + amount)]
+                        extents.append((start, start + amount))
                         remaining = remaining - amount
                     
-                    file_obj = ADFSfile(name, file, load, exe, length)
                     # Store the SIN (System Internal Number) for debugging.
-                    file_obj.addr = self._str2num(3, self.sectors[head+p+22:head+p+25])
-                    files.append(file_obj)
+                    files.append(ADFSfile(name, None, load, exe, length,
+                                          extents, self.sectors, sin))
             
             p = p + 26
         
@@ -732,12 +1707,9 @@ class ADFSnewMap(ADFSmap):
         
         return dir_name, files
     
-    def _read_new_address(self, s):
+    def _read_new_address(self, value):
     
-        # From the three character string passed, determine the address on the
-        # disc.
-        value = self._str2num(3, s)
-        
+        # From the value passed, determine the address on the disc.
         # This is a SIN (System Internal Number)
         # The bottom 8 bits are the sector offset + 1
         offset = value & 0xff
@@ -773,85 +1745,155 @@ class ADFSnewMap(ADFSmap):
         
             return []
     
-    def find_address_from_map(self, addr, begin, entry):
+    def find_address_from_map(self, zone, bit):
     
-        return ((addr - begin) * self.sector_size)
+        """Returns the disc address described by the given bit in a zone of
+        the map."""
+        
+        start_bit, end_bit, first_unit = self.zone_layout[zone]
+        return (first_unit + bit - start_bit) << self.log2_bytes_per_bit
 
 
 class ADFSbigNewMap(ADFSnewMap):
 
     dir_markers = ('Nick',)
     root_dir_address = 0xc8800
-    
-    def find_address_from_map(self, addr, begin, entry):
-    
-        # I can't remember where the rationale for this calculation
-        # came from or where the necessary information was obtained.
-        # It probably came from one of the WSS files, such as
-        # Formats.htm or Formats2.htm which imply that the F format
-        # uses 512 byte sectors (see the 0x200 value below) and
-        # indicate that F format uses 4 zones rather than 1.
-        
-        upper = (entry & 0x7f00) >> 8
-        
-        if upper > 1:
-            upper = upper - 1
-        if upper > 3:
-            upper = 3
-        
-        return ((addr - begin) - (upper * 0xc8)) * 0x200
 
 
 class ADFSoldMap(ADFSmap):
 
-    def _read_free_space(self):
+    """map = ADFSoldMap(sectors)
+    
+    Decodes the old style free space map stored in the first two 256 byte
+    sectors of the string or memory map, sectors, as used by S, M, L and D
+    format discs. Only the first 512 bytes of the disc image are read.
+    
+    The free_space attribute contains a list of pairs of disc addresses
+    delimiting each free space fragment. The disc_size, disc_name, disc_id
+    and boot_option attributes contain the values stored in the map, and
+    the checksums attribute contains a pair of (stored, calculated)
+    checksums for each sector of the map.
+    """
     
-        # Currently unused
+    # The map describes the disc in units of this many bytes.
+    unit = 256
+    
+    # The maximum number of entries in the free space list.
+    max_entries = 82
+    
+    def __init__(self, sectors):
+    
+        self.sectors = sectors
+        self.disc_map = {}
+        self.free_space = self._read_free_space()
         
-        base = 0
-        free_space = []
-        p = 0
-        while self.sectors[base+p] != 0:
+        # The second half of each sector contains information about the disc.
+        self.disc_size = self._str2num(3, sectors[0xfc:0xff]) * self.unit
+        self.disc_id = self._read_unsigned_half_word(sectors[0x1fb:0x1fd])
+        self.boot_option = ord(sectors[0x1fd])
         
-            free.append(self._str2num(3, self.sectors[base+p:base+p+3]))
+        # The characters of the disc name are stored alternately in each
+        # sector.
+        name = ""
+        even = sectors[0xf7:0xfc]
+        odd = sectors[0x1f6:0x1fb]
         
-        name = self.sectors[self.sector_size-9:self.sector_size-4]
+        for i in range(5):
+            name = name + even[i] + odd[i]
         
-        disc_size = self._str2num(
-            3, self.sectors[self.sector_size-4:self.sector_size-1]
-            )
+        self.disc_name = string.rstrip(self._safe(name, with_space = 1))
         
-        checksum0 = self._read_unsigned_byte(self.sectors[self.sector_size-1])
+        self.checksums = [(ord(sectors[0xff]), self._checksum(0)),
+                          (ord(sectors[0x1ff]), self._checksum(0x100))]
+    
+    def _read_free_space(self):
+    
+        # The first sector holds the start address and the second sector
+        # holds the length of each free space fragment, in units of 256
+        # bytes. The byte before the last in the second sector holds the
+        # length of each list in bytes.
+        length = min(ord(self.sectors[0x1fe]), self.max_entries * 3)
+        starts = self.sectors[:length]
+        lengths = self.sectors[0x100:0x100 + length]
         
-        base = self.sector_size
+        free_space = []
         
-        p = 0
-        while self.sectors[base+p] != 0:
+        for p in range(0, length - 2, 3):
         
-            free.append(self._str2num(3, self.sectors[base+p:base+p+3]))
+            start = self._str2num(3, starts[p:p+3]) * self.unit
+            free_length = self._str2num(3, lengths[p:p+3]) * self.unit
+            
+            if free_length != 0:
+                free_space.append((start, start + free_length))
         
-        name = name + \
-            self.sectors[base+self.sector_size-10:base+self.sector_size-5]
+        return free_space
+    
+    def _checksum(self, base):
+    
+        # Add the first 255 bytes in the sector from the end to the start
+        # with carry, starting with 255.
+        data = self.sectors[base:base + 0xff]
+        total = 255
+        carry = 0
         
-        disc_id = self._str2num(
-            2, self.sectors[base+self.sector_size-5:base+self.sector_size-3]
-            )
+        for i in range(254, -1, -1):
         
-        boot = self._read_unsigned_byte(self.sectors[base+self.sector_size-3])
+            total = total + ord(data[i]) + carry
+            carry = total >> 8
+            total = total & 0xff
         
-        checksum1 = self._read_unsigned_byte(self.sectors[base+self.sector_size-1])
+        return total
+    
+    def valid(self):
+    
+        """Returns True if the checksums stored in the map are correct."""
         
-        return free_space
+        for stored, calculated in self.checksums:
+        
+            if stored != calculated:
+                return False
+        
+        return True
 
 
 class ADFSdisc(Utilities):
 
-    """disc = ADFSdisc(file_handle, verify = 0)
+    """disc = ADFSdisc(file_handle, verify = 0, use_mmap = 0, lazy = 0)
     
     Represents an ADFS disc image stored in the file with the specified file
     handle. The image is not verified by default; pass True or another
     non-False value to request automatic verification of the disc format.
     
+    If use_mmap is set to True or another non-False value, the image is
+    mapped into memory instead of being read, so that its contents are only
+    read from the file when they are needed. If the file handle does not
+    refer to a file that can be mapped, the image is read as usual.
+    Interleaved L format images are accessed through an ADFSinterleavedImage
+    view in both cases, so their tracks are never copied into a new order.
+    
+    If lazy is set to True or another non-False value, only the root
+    directory is read when the instance is created. Each subdirectory is
+    read when the files attribute of its ADFSdirectory instance is first
+    accessed, and any problems found in it are only added to the
+    verification log at that point.
+    
+    The time taken by each phase of reading the disc and counts of the work
+    done, such as the number of directories parsed and fragments found in
+    the map, are recorded in the stats dictionary. When directories are read
+    lazily, the counts are updated as each directory is read. The work done
+    to decode the map is not counted when it is loaded from a cache file.
+    
+    If cache_dir is the path of a directory, the catalogue and map of the
+    disc are stored in a file in that directory after they are read, and are
+    read from that file instead of the disc image when an image with the same
+    contents is opened again. Images are identified by a hash of their
+    contents, which is only recalculated if the length or modification time
+    of the image file changes. The cache is not used if verify is set, and is
+    only written if lazy is not set.
+    
+    Instances can also be created for images held in memory by calling the
+    from_buffer() class method, which reads the image in place.
+    
     If the disc image specified cannot be read successfully, an ADFS_exception
     is raised.
     
@@ -864,6 +1906,11 @@ class ADFSdisc(Utilities):
     from the disc's catalogue, including both directories and files,
     represented by ADFSdirectory and ADFSfile instances respectively.
     
+    Objects can be found by their ADFS paths, such as "$.Games.Elite", using
+    the lookup() method, and files can be obtained using the open() method.
+    The open_stream() method returns a file-like object which reads a file's
+    contents from the disc image on demand.
+    
     The contents of the disc can be extracted to a directory structure in the
     user's filing system with the extract_files() method.
     
@@ -880,16 +1927,52 @@ class ADFSdisc(Utilities):
                      "adE": "ADFS E format",
                      "adEbig": "ADFS F format"}
     
-    def __init__(self, adf, verify = 0):
+    def __init__(self, adf, verify = 0, use_mmap = 0, lazy = 0,
+                 cache_dir = None, data = None):
     
         # Log problems if the verify flag is set.
         self.verify = verify
         self.verify_log = []
         
+        # Read subdirectories when they are needed if the lazy flag is set.
+        self.lazy = lazy
+        
+        # Index objects by their paths when they are looked up.
+        self._path_index = {}
+        self._name_index = {}
+        
+        # Record the time taken by each phase of reading the disc and
+        # counts of the work done.
+        self.stats = {"read time": 0.0, "identify time": 0.0,
+                      "map time": 0.0, "catalogue time": 0.0,
+                      "cache time": 0.0, "bytes read": 0,
+                      "bytes mapped": 0, "cache bytes read": 0,
+                      "map bytes scanned": 0, "fragments found": 0,
+                      "free fragments found": 0, "directories parsed": 0,
+                      "entries decoded": 0}
+        
+        started = time.time()
+        
+        # Use the image data supplied or map the image into memory if
+        # requested; otherwise it will be read when the format is known.
+        if data is not None:
+            self.sectors = self._buffer_image(data)
+        elif use_mmap:
+            self.sectors = self._map_image(adf)
+            if self.sectors is not None:
+                self._count("bytes mapped", len(self.sectors))
+        else:
+            self.sectors = None
+        
+        mapped = self.sectors is not None
+        
         # Check the properties using the length of the file
-        adf.seek(0,2)
-        length = adf.tell()
-        adf.seek(0,0)
+        if mapped:
+            length = len(self.sectors)
+        else:
+            adf.seek(0,2)
+            length = adf.tell()
+            adf.seek(0,0)
         
         if length == 163840:
             self.ntracks = 40
@@ -925,7 +2008,9 @@ class ADFSdisc(Utilities):
             interleave = 0
             self.dir_markers = ('Hugo', 'Nick')
             
+            start = time.time()
             format = self._identify_format(adf)
+            self._count("identify time", time.time() - start)
             
             if format == 'D':
             
@@ -948,49 +2033,278 @@ class ADFSdisc(Utilities):
             self.disc_type = 'adEbig'
             self.dir_markers = ('Nick',)
         
-        else:
-            raise ADFS_exception, 'Please supply a .adf, .adl or .adD file.'
+        else:
+            raise ADFS_exception, 'Please supply a .adf, .adl or .adD file.'
+        
+        # Read tracks unless the image is already mapped.
+        start = time.time()
+        
+        if not mapped:
+            self.sectors = self._read_tracks(adf, interleave)
+            self._count("bytes read", len(self.sectors))
+        else:
+            self.sectors = self._arrange_tracks(self.sectors, interleave)
+        
+        self._count("read time", time.time() - start)
+        
+        # Check the free space map of old format discs when verifying.
+        if verify and self.disc_type in ('ads', 'adm', 'adl', 'adD'):
+            self._verify_old_map(length)
+        
+        # Find the catalogue cache file for the image if a cache is used.
+        # The cache is not used when verifying the disc.
+        if cache_dir is not None and not verify:
+            self.cache_file = self._catalogue_cache_file(adf, cache_dir)
+        else:
+            self.cache_file = None
+        
+        # Close the ADF file, if one was given.
+        if adf is not None:
+            adf.close()
+        
+        # Set the default disc name.
+        self.disc_name = 'Untitled'
+        
+        # Use the catalogue from the cache if possible.
+        if self.cache_file is not None:
+        
+            start = time.time()
+            loaded = self._load_catalogue()
+            self._count("cache time", time.time() - start)
+            
+            if loaded:
+                self.stats["total time"] = time.time() - started
+                return
+        
+        # Read the files on the disc.
+        
+        if self.disc_type == 'adD':
+        
+            # Find the root directory name and all the files and directories
+            # contained within it.
+            start = time.time()
+            self.root_name, self.files = self._read_old_catalogue(0x400)
+            self._count("catalogue time", time.time() - start)
+        
+        elif self.disc_type == 'adE':
+        
+            # Read the disc name and map
+            start = time.time()
+            self.disc_name = self._safe(self._read_disc_info(), with_space = 1)
+            self._count("map time", time.time() - start)
+            
+            # Find the root directory name and all the files and directories
+            # contained within it.
+            start = time.time()
+            self.root_name, self.files = self.disc_map.read_catalogue(2*self.sector_size)
+            self._count("catalogue time", time.time() - start)
+        
+        elif self.disc_type == 'adEbig':
+        
+            # Read the disc name and map
+            start = time.time()
+            self.disc_name = self._safe(self._read_disc_info(), with_space = 1)
+            self._count("map time", time.time() - start)
+            
+            # Find the root directory name and all the files and directories
+            # contained within it. The 
+            start = time.time()
+            self.root_name, self.files = self.disc_map.read_catalogue((self.ntracks * self.nsectors/2 + 2) * self.sector_size)
+            self._count("catalogue time", time.time() - start)
+        
+        else:
+        
+            # Find the root directory name and all the files and directories
+            # contained within it.
+            start = time.time()
+            self.root_name, self.files = self._read_old_catalogue(2*self.sector_size)
+            self._count("catalogue time", time.time() - start)
+        
+        # Store the catalogue in the cache unless only part of it was read.
+        if self.cache_file is not None and not lazy:
+            self._save_catalogue()
+        
+        self.stats["total time"] = time.time() - started
+    
+    def _catalogue_cache_file(self, adf, cache_dir):
+    
+        # Cache files are named using a hash of the image's contents and its
+        # length. To avoid hashing an image each time it is opened, an index
+        # file for each image path records the name of its cache file along
+        # with the image's length and modification time.
+        if isinstance(self.sectors, ADFSinterleavedImage):
+            data = self.sectors.data
+        else:
+            data = self.sectors
+        
+        # Hash the memory view itself rather than the object used to read it.
+        if isinstance(data, ADFSbufferView):
+            data = data.view
+        
+        self.cache_index = None
+        
+        try:
+        
+            path = os.path.abspath(adf.name)
+            
+            if os.path.isfile(path):
+            
+                key = (path, len(data), os.fstat(adf.fileno()).st_mtime)
+                index_file = os.path.join(
+                    cache_dir, hashlib.sha1(path).hexdigest() + ".adfsindex"
+                    )
+                self.cache_index = (index_file, key)
+        
+        except (AttributeError, EnvironmentError, TypeError, ValueError):
+            pass
+        
+        if self.cache_index is not None:
+        
+            try:
+            
+                f = open(index_file, "rb")
+                try:
+                    stored_key, name = marshal.load(f)
+                finally:
+                    f.close()
+                
+                if stored_key == key:
+                
+                    # The index is up to date so it does not need writing.
+                    self.cache_index = None
+                    return os.path.join(cache_dir, name)
+            
+            except (EnvironmentError, EOFError, ValueError, TypeError):
+                pass
+        
+        name = "%s-%i.adfscache" % (hashlib.sha1(data).hexdigest(), len(data))
+        return os.path.join(cache_dir, name)
+    
+    def _write_cache_file(self, path, value):
+    
+        # Write the cache file under a temporary name and rename it so that
+        # other processes never read an incomplete file. Failure to write
+        # the cache is not an error.
+        temporary = "%s.%i" % (path, os.getpid())
+        
+        try:
+        
+            cache_dir = os.path.dirname(path)
+            if cache_dir != "" and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            
+            f = open(temporary, "wb")
+            marshal.dump(value, f)
+            f.close()
+            os.rename(temporary, path)
+        
+        except (EnvironmentError, ValueError):
+            pass
+    
+    def _update_cache_index(self):
+    
+        if self.cache_index is not None:
+        
+            index_file, key = self.cache_index
+            self._write_cache_file(
+                index_file, (key, os.path.basename(self.cache_file))
+                )
+    
+    def _dump_objects(self, objects):
+    
+        # Convert the objects in a directory into tuples for storage:
+        # (name, address, objects) for directories and
+        # (name, load address, execution address, length, extents, SIN)
+        # for files.
+        items = []
+        
+        for obj in objects:
+        
+            if isinstance(obj, ADFSfile):
+            
+                items.append(
+                    (obj.name, obj.load_address, obj.execution_address,
+                     obj.length, obj.extents, obj.addr)
+                    )
+            
+            else:
+            
+                items.append(
+                    (obj.name, obj.address, self._dump_objects(obj.files))
+                    )
+        
+        return items
+    
+    def _load_objects(self, items):
+    
+        objects = []
         
-        # Read tracks
-        self.sectors = self._read_tracks(adf, interleave)
+        for item in items:
         
-        # Close the ADF file
-        adf.close()
+            if len(item) == 3:
+            
+                name, address, lower_items = item
+                objects.append(
+                    ADFSdirectory(name, self._load_objects(lower_items), address)
+                    )
+            
+            else:
+            
+                name, load, exe, length, extents, addr = item
+                objects.append(ADFSfile(name, None, load, exe, length,
+                                        extents, self.sectors, addr))
         
-        # Set the default disc name.
-        self.disc_name = 'Untitled'
+        return objects
+    
+    def _save_catalogue(self):
+    
+        if hasattr(self, "disc_map"):
+            decoded = (self.disc_map.free_space, self.disc_map.disc_map)
+        else:
+            decoded = None
         
-        # Read the files on the disc.
+        catalogue = {"version": catalogue_cache_version,
+                     "disc type": self.disc_type,
+                     "disc name": self.disc_name,
+                     "root name": self.root_name,
+                     "files": self._dump_objects(self.files),
+                     "map": decoded}
         
-        if self.disc_type == 'adD':
+        self._write_cache_file(self.cache_file, catalogue)
+        self._update_cache_index()
+    
+    def _load_catalogue(self):
+    
+        # Returns True if the catalogue was read from the cache.
+        try:
         
-            # Find the root directory name and all the files and directories
-            # contained within it.
-            self.root_name, self.files = self._read_old_catalogue(0x400)
+            f = open(self.cache_file, "rb")
+            try:
+                catalogue = marshal.load(f)
+                self._count("cache bytes read", f.tell())
+            finally:
+                f.close()
         
-        elif self.disc_type == 'adE':
+        except (EnvironmentError, EOFError, ValueError, TypeError):
+            return 0
         
-            # Read the disc name and map
-            self.disc_name = self._safe(self._read_disc_info(), with_space = 1)
+        if not isinstance(catalogue, dict) or \
+            catalogue.get("version") != catalogue_cache_version or \
+            catalogue.get("disc type") != self.disc_type:
             
-            # Find the root directory name and all the files and directories
-            # contained within it.
-            self.root_name, self.files = self.disc_map.read_catalogue(2*self.sector_size)
+            return 0
         
-        elif self.disc_type == 'adEbig':
+        if catalogue["map"] is not None:
         
-            # Read the disc name and map
-            self.disc_name = self._safe(self._read_disc_info(), with_space = 1)
-            
-            # Find the root directory name and all the files and directories
-            # contained within it. The 
-            self.root_name, self.files = self.disc_map.read_catalogue((self.ntracks * self.nsectors/2 + 2) * self.sector_size)
+            # Read the disc record and create the map from its decoded form.
+            self._read_disc_info(catalogue["map"])
         
-        else:
+        self.disc_name = catalogue["disc name"]
+        self.root_name = catalogue["root name"]
+        self.files = self._load_objects(catalogue["files"])
         
-            # Find the root directory name and all the files and directories
-            # contained within it.
-            self.root_name, self.files = self._read_old_catalogue(2*self.sector_size)
+        self._update_cache_index()
+        return 1
     
     def _identify_format(self, adf):
     
@@ -1003,9 +2317,11 @@ class ADFSdisc(Utilities):
         # image represents an 800K D or E format floppy disc. First, the
         # disc image needs to be read.
         
-        # Read all the data in the image. This will be overwritten
-        # when the image is read properly.
-        self.sectors = adf.read()
+        # Read all the data in the image unless it has already been mapped.
+        # This will be overwritten when the image is read properly.
+        if self.sectors is None:
+            self.sectors = adf.read()
+            self._count("bytes read", len(self.sectors))
         
         # This will be done again for E format and later discs.
         
@@ -1022,10 +2338,7 @@ class ADFSdisc(Utilities):
         
         # Check the disc image length.
         
-        # Seek to the end of the disc image.
-        adf.seek(0, 2)
-        
-        if record["disc size"] == adf.tell():
+        if record["disc size"] == len(self.sectors):
         
             # The record (if is exists) does not provide a consistent value
             # for the length of the image file.
@@ -1047,8 +2360,8 @@ class ADFSdisc(Utilities):
         
         # Check the data at the root directory location.
         
-        adf.seek((record["root dir"] * record["sector size"]) + 1, 0)
-        word = adf.read(4)
+        offset = (record["root dir"] * record["sector size"]) + 1
+        word = self.sectors[offset:offset + 4]
         
         if word == "Hugo" or word == "Nick":
         
@@ -1081,11 +2394,8 @@ class ADFSdisc(Utilities):
         
         # Simple test for D and E formats: look for Hugo at 0x401 for D format
         # and Nick at 0x801 for E format
-        adf.seek(0x401)
-        word1 = adf.read(4)
-        adf.seek(0x801)
-        word2 = adf.read(4)
-        adf.seek(0)
+        word1 = self.sectors[0x401:0x405]
+        word2 = self.sectors[0x801:0x805]
         
         if word1 == 'Hugo':
         
@@ -1135,76 +2445,7 @@ class ADFSdisc(Utilities):
             
             return '?'
     
-    def _read_disc_record(self, offset):
-    
-        """Reads the disc record for D and E format disc images and returns a
-        dictionary describing the disc image.
-        """
-        
-        # See ADFS/DiscRecord.htm for details.
-        
-        # Total sectors per track (sectors * heads)
-        log2_sector_size = ord(self.sectors[offset])
-        # Sectors per track
-        nsectors = ord(self.sectors[offset + 1])
-        # Heads per track
-        heads = ord(self.sectors[offset + 2])
-        
-        density = ord(self.sectors[offset+3])
-        
-        if density == 1:
-        
-            density = 'single'        # Single density disc
-            sector_size = 256
-        
-        elif density == 2:
-        
-            density = 'double'        # Double density disc
-            sector_size = 512
-        
-        elif density == 3:
-        
-            density = 'quad'        # Quad density disc
-            sector_size = 1024
-        
-        else:
-        
-            density = 'unknown'
-        
-        # Length of ID fields in the disc map
-        idlen = self._read_unsigned_byte(self.sectors[offset + 4])
-        # Number of bytes per map bit.
-        bytes_per_bit = 2 ** self._read_unsigned_byte(self.sectors[offset + 5])
-        # LowSector
-        # StartUp
-        # LinkBits
-        # BitSize (size of ID field?)
-        bit_size = self._read_unsigned_byte(self.sectors[offset + 6 : offset + 7])
-        #print "Bit size: %s" % hex(bit_size)
-        # RASkew
-        # BootOpt
-        # Zones
-        zones = ord(self.sectors[offset + 9])
-        # ZoneSpare
-        # RootDir
-        root = self._str2num(3, self.sectors[offset + 13 : offset + 16]) # was 15
-        # Identify
-        # SequenceSides
-        # DoubleStep
-        # DiscSize
-        disc_size = self._read_unsigned_word(self.sectors[offset + 16 : offset + 20])
-        # DiscId
-        disc_id   = self._read_unsigned_half_word(self.sectors[offset + 20 : offset + 22])
-        # DiscName
-        disc_name = string.strip(self.sectors[offset + 22 : offset + 32])
-        
-        return {'sectors': nsectors, 'log2 sector size': log2_sector_size,
-            'sector size': 2**log2_sector_size, 'heads': heads,
-            'density': density,
-            'disc size': disc_size, 'disc ID': disc_id,
-            'disc name': disc_name, 'zones': zones, 'root dir': root }
-    
-    def _read_disc_info(self):
+    def _read_disc_info(self, decoded = None):
     
         checksum = ord(self.sectors[0])
         first_free = self._read_unsigned_half_word(self.sectors[1:3])
@@ -1219,7 +2460,13 @@ class ADFSdisc(Utilities):
             self.map_start, self.map_end = 0x40, 0x400
             self.disc_map = ADFSnewMap(self.map_header, self.map_start,
                                        self.map_end, self.sectors,
-                                       self.sector_size, self.record)
+                                       self.sector_size, self.record,
+                                       decoded)
+            self._share_settings(self.disc_map)
+            
+            # Only count the work done if the map was decoded from the disc.
+            if decoded is None:
+                self._count_map(self.disc_map)
             
             return self.record['disc name']
         
@@ -1233,64 +2480,157 @@ class ADFSdisc(Utilities):
             self.map_start, self.map_end = 0xc6840, 0xc7800
             self.disc_map = ADFSbigNewMap(self.map_header, self.map_start,
                                           self.map_end, self.sectors,
-                                          self.sector_size, self.record)
+                                          self.sector_size, self.record,
+                                          decoded)
+            self._share_settings(self.disc_map)
+            
+            if decoded is None:
+                self._count_map(self.disc_map)
             
             return self.record['disc name']
         
         else:
             return 'Unknown'
     
-    def _read_tracks(self, f, inter):
+    def _verify_old_map(self, length):
     
-        t = ""
+        old_map = ADFSoldMap(self.sectors)
         
-        f.seek(0, 0)
+        for sector, (stored, calculated) in zip((0, 1), old_map.checksums):
         
-        if inter==0:
-            try:
-                for i in range(0, self.ntracks):
-                
-                    t = t + f.read(self.nsectors * self.sector_size)
+            if stored != calculated:
             
-            except IOError:
-                print 'Less than %i tracks found.' % self.ntracks
-                f.close()
-                raise ADFS_exception, \
-                    'Less than %i tracks found.' % self.ntracks
+                self.verify_log.append(
+                    ( WARNING,
+                      "Free space map checksum in sector %i is %02x; " % \
+                      (sector, stored) + "expected %02x" % calculated )
+                    )
         
-        else:
+        if old_map.disc_size != length:
         
-            # Tracks are interleaved (0 80 1 81 2 82 ... 79 159) so rearrange
-            # them into the form (0 1 2 3 ... 159)
-            
-            try:
-            
-                for i in range(0, self.ntracks):
-                
-                    if i < (self.ntracks >> 1):
-                        f.seek(i*2*self.nsectors*self.sector_size, 0)
-                        t = t + f.read(self.nsectors*self.sector_size)
-                    else:
-                        j = i - (self.ntracks >> 1)
-                        f.seek(((j*2)+1)*self.nsectors*self.sector_size, 0)
-                        t = t + f.read(self.nsectors*self.sector_size)
-            
-            except IOError:
-            
-                print 'Less than %i tracks found.' % self.ntracks
-                f.close()
-                raise ADFS_exception, \
-                    'Less than %i tracks found.' % self.ntracks
+            self.verify_log.append(
+                ( WARNING,
+                  "Free space map gives a disc size of %i bytes for an " % \
+                  old_map.disc_size + "image of %i bytes" % length )
+                )
+        
+        self.verify_log.append(
+            ( INFORM,
+              self._plural(
+                  "%i free space %s in the map.", [len(old_map.free_space)],
+                  [("fragments", "fragment", "fragments")]
+                  ) )
+            )
+    
+    def _share_settings(self, disc_map):
+    
+        # Let the map use the same verification log, catalogue reading
+        # settings and statistics as the disc when it reads directories.
+        disc_map.verify = self.verify
+        disc_map.verify_log = self.verify_log
+        disc_map.lazy = self.lazy
+        disc_map.stats = self.stats
+    
+    def _count_map(self, disc_map):
+    
+        self._count("map bytes scanned", disc_map.zones * disc_map.sector_size)
+        self._count("free fragments found", len(disc_map.free_space))
+        
+        for pieces in disc_map.disc_map.values():
+            self._count("fragments found", len(pieces))
+    
+    def from_buffer(cls, buf, verify = 0, lazy = 0, cache_dir = None):
+        
+        """disc = ADFSdisc.from_buffer(buf, verify = 0, lazy = 0,
+                                       cache_dir = None)
+        
+        Returns an ADFSdisc instance for the disc image held in buf, which
+        can be a string, bytearray, mmap, memoryview or any other object
+        supporting the buffer protocol. The image is read in place without
+        being copied, so buf must not be modified while the instance is in
+        use, and it is never closed. The other arguments are the same as
+        those used when creating an instance from a file.
+        """
+        
+        return cls(None, verify, lazy = lazy, cache_dir = cache_dir,
+                   data = buf)
+    
+    from_buffer = classmethod(from_buffer)
+    
+    def _buffer_image(self, data):
+    
+        """Returns an object which reads the disc image in data as a string
+        without copying it.
+        """
+        
+        if isinstance(data, (str, buffer, mmap.mmap)):
+            return data
+        elif isinstance(data, memoryview):
+            return ADFSbufferView(data)
+        
+        try:
+            return buffer(data)
+        except TypeError:
+            raise ADFS_exception, \
+                'Disc image data must support the buffer protocol.'
+    
+    def _map_image(self, f):
+    
+        """Returns a read-only memory map of the disc image in the file
+        object, f, or None if the file cannot be mapped.
+        """
+        
+        try:
+            return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError):
+            return None
+    
+    def _read_tracks(self, f, inter):
+    
+        f.seek(0, 0)
+        
+        try:
+            t = f.read(self.ntracks * self.nsectors * self.sector_size)
+        
+        except IOError:
+            t = ""
+        
+        if len(t) < self.ntracks * self.nsectors * self.sector_size:
+        
+            print 'Less than %i tracks found.' % self.ntracks
+            f.close()
+            raise ADFS_exception, \
+                'Less than %i tracks found.' % self.ntracks
         
-        return t
+        return self._arrange_tracks(t, inter)
+    
+    def _arrange_tracks(self, t, inter):
+    
+        if inter == 0:
+            return t
+        
+        # Tracks are interleaved (0 80 1 81 2 82 ... 79 159) so present
+        # them in the form (0 1 2 3 ... 159) without copying them.
+        return ADFSinterleavedImage(
+            t, self.ntracks, self.nsectors * self.sector_size
+            )
     
     def _read_old_catalogue(self, base):
     
         head = base
         p = 0
         
-        dir_seq = self.sectors[head + p]
-        dir_start = self.sectors[head+p+1:head+p+5]
+        # Read the directory entries in one piece rather than reading each
+        # field from the disc image.
+        if self.disc_type == 'adD':
+            entries_end = self.sector_size * 2
+        else:
+            entries_end = self.sector_size * 5
+        
+        directory = self.sectors[head:head + entries_end]
+        
+        dir_seq = directory[p]
+        dir_start = directory[p+1:p+5]
         if dir_start not in self.dir_markers:
         
             if self.verify:
@@ -1305,32 +2645,23 @@ class ADFSdisc(Utilities):
         
         files = []
         
-        while ord(self.sectors[head+p]) != 0:
+        self._count("directories parsed")
+        
+        while p + 26 <= entries_end and ord(directory[p]) != 0:
         
-            old_name = self.sectors[head+p:head+p+10]
-            top_set = 0
-            counter = 1
-            for i in old_name:
-                if (ord(i) & 128) != 0:
-                    top_set = counter
-                counter = counter + 1
+            self._count("entries decoded")
             
-            name = self._safe(self.sectors[head+p:head+p+10])
+            old_name, load, exe, length, address_low, address_high, \
+                olddirobseq = _directory_entry.unpack_from(directory, p)
             
-            load = self._read_unsigned_word(self.sectors[head+p+10:head+p+14])
-            exe = self._read_unsigned_word(self.sectors[head+p+14:head+p+18])
-            length = self._read_unsigned_word(self.sectors[head+p+18:head+p+22])
+            name = self._safe(old_name)
+            
+            inddiscadd = address_low | (address_high << 16)
             
             if self.disc_type == 'adD':
-                inddiscadd = 256 * self._str2num(
-                    3, self.sectors[head+p+22:head+p+25]
-                    )
+                inddiscadd = 256 * inddiscadd
             else:
-                inddiscadd = self.sector_size * self._str2num(
-                    3, self.sectors[head+p+22:head+p+25]
-                    )
-            
-            olddirobseq = self._read_unsigned_byte(self.sectors[head+p+25])
+                inddiscadd = self.sector_size * inddiscadd
             
             if self.disc_type == 'adD':
             
@@ -1338,35 +2669,50 @@ class ADFSdisc(Utilities):
                 if (olddirobseq & 0x8) == 0x8:
                 
                     # A directory has been found.
-                    lower_dir_name, lower_files = \
-                        self._read_old_catalogue(inddiscadd)
-                        
-                    files.append(ADFSdirectory(name, lower_files))
+                    files.append(self._read_directory(
+                        name, inddiscadd, self._read_old_catalogue
+                        ))
                 
                 else:
                 
                     # A file has been found.
-                    data = self.sectors[inddiscadd:inddiscadd+length]
-                    files.append(ADFSfile(name, data, load, exe, length))
+                    files.append(ADFSfile(
+                        name, None, load, exe, length,
+                        [(inddiscadd, inddiscadd + length)], self.sectors
+                        ))
             
             else:
             
                 # Old format < 800K discs.
+                # Find the last character in the name with its top bit set,
+                # but only when the entry could describe a directory.
+                top_set = 0
+                
+                if (load == 0 and exe == 0) or \
+                    length == (self.sector_size * 5):
+                    
+                    counter = 1
+                    for i in old_name:
+                        if (ord(i) & 128) != 0:
+                            top_set = counter
+                        counter = counter + 1
+                
                 # [Needs more accurate check for directories.]
                 if (load == 0 and exe == 0 and top_set > 2) or \
                     (top_set > 0 and length == (self.sector_size * 5)):
                 
                     # A directory has been found.
-                    lower_dir_name, lower_files = \
-                        self._read_old_catalogue(inddiscadd)
-                    
-                    files.append(ADFSdirectory(name, lower_files))
+                    files.append(self._read_directory(
+                        name, inddiscadd, self._read_old_catalogue
+                        ))
                 
                 else:
                 
                     # A file has been found.
-                    data = self.sectors[inddiscadd:inddiscadd+length]
-                    files.append(ADFSfile(name, data, load, exe, length))
+                    files.append(ADFSfile(
+                        name, None, load, exe, length,
+                        [(inddiscadd, inddiscadd + length)], self.sectors
+                        ))
             
             p = p + 26
         
@@ -1422,25 +2768,237 @@ class ADFSdisc(Utilities):
         
         if parent == head:
         
-            # Use the directory title as the disc name.
-            
-            # Note that the title may contain spaces.
-            self.disc_name = self._safe(dir_title, with_space = 1)
+            # Use the directory title as the disc name.
+            
+            # Note that the title may contain spaces.
+            self.disc_name = self._safe(dir_title, with_space = 1)
+        
+        endseq = self.sectors[tail+self.sector_size-6]
+        if endseq != dir_seq:
+        
+            if self.verify:
+            
+                self.verify_log.append(
+                    ( WARNING,
+                      'Broken directory: %s at [%x, %x]' % \
+                      (dir_title, head, tail) )
+                    )
+            
+            return dir_name, files
+        
+        return dir_name, files
+    
+    def lookup(self, path):
+    
+        """Returns the ADFSfile or ADFSdirectory instance for the object with
+        the given ADFS path, such as "$.Games.Elite". Paths that do not start
+        with "$" are relative to the root directory. As in ADFS, the case of
+        the names in the path is ignored.
+        
+        Each directory is indexed by name when a path leading through it is
+        first looked up, and the result of each successful lookup is cached,
+        so repeated lookups take constant time.
+        
+        If the object cannot be found, an ADFS_exception is raised.
+        """
+        
+        elements = string.split(string.lower(path), ".")
+        
+        if elements[0] == "$":
+            elements = elements[1:]
+        
+        key = string.join(["$"] + elements, ".")
+        
+        try:
+            return self._path_index[key]
+        except KeyError:
+            pass
+        
+        obj = ADFSdirectory("$", self.files)
+        built = "$"
+        
+        for element in elements:
+        
+            if not isinstance(obj, ADFSdirectory):
+                raise ADFS_exception, "Not a directory: %s" % built
+            
+            names = self._name_index.get(built)
+            
+            if names is None:
+            
+                # Index the directory by name, using the first of any objects
+                # which have the same name.
+                names = {}
+                
+                for lower_obj in obj.files:
+                
+                    name = string.lower(lower_obj.name)
+                    
+                    if not names.has_key(name):
+                        names[name] = lower_obj
+                
+                self._name_index[built] = names
+            
+            try:
+                obj = names[element]
+            except KeyError:
+                raise ADFS_exception, "Object not found: %s" % path
+            
+            built = built + "." + element
+        
+        self._path_index[key] = obj
+        return obj
+    
+    def open(self, path):
+    
+        """Returns the ADFSfile instance for the file with the given ADFS
+        path. See the lookup() method for details of the paths accepted.
+        
+        If the file cannot be found, or if the path refers to a directory,
+        an ADFS_exception is raised.
+        """
+        
+        obj = self.lookup(path)
+        
+        if isinstance(obj, ADFSdirectory):
+            raise ADFS_exception, "Not a file: %s" % path
+        
+        return obj
+    
+    def open_stream(self, file_obj):
+    
+        """Returns a read-only, seekable file-like object for the contents of
+        the file described by file_obj, which is either an ADFSfile instance
+        or the ADFS path of a file. The contents are read from the disc image
+        as they are requested.
+        """
+        
+        if isinstance(file_obj, basestring):
+            file_obj = self.open(file_obj)
+        
+        return ADFSfileStream(file_obj)
+    
+    def catalogue_table(self, files = None, use_numpy = 1):
+    
+        """Returns a table describing the objects in the catalogue, or in the
+        list of objects given, and all the objects they contain, with one row
+        per object. Each object's row number is its path id, and directories
+        appear before the objects they contain.
+        
+        The columns are given by catalogue_columns: the path id, the path id
+        of the parent directory (-1 for objects at the top level), the name,
+        the load and execution addresses, the length, the filetype (-1 if
+        the file has none), whether the object is a directory, and the
+        offset of the object's first byte in the disc image (-1 for empty
+        files). Directories have zero load and execution addresses and
+        lengths.
+        
+        If NumPy is available and use_numpy is set to True or another
+        non-False value, the table is a structured array with a field for
+        each column. Otherwise, it is a dictionary mapping the column names
+        to array module arrays, except for names, which are stored in a list.
+        """
+        
+        if files is None:
+        
+            files = self.files
+        
+        columns = []
+        
+        for column, typecode in catalogue_columns:
+        
+            if typecode is None:
+                columns.append([])
+            else:
+                columns.append(array.array(typecode))
+        
+        (path_ids, parent_ids, names, loads, exes, lengths, filetypes,
+         directories, offsets) = columns
+        
+        # Visit the objects in depth-first order, recording the path id of
+        # the parent of each group of objects.
+        pending = [(-1, files)]
+        
+        while pending:
+        
+            parent, objects = pending.pop()
+            lower = []
+            
+            for obj in objects:
+            
+                path_id = len(path_ids)
+                path_ids.append(path_id)
+                parent_ids.append(parent)
+                names.append(obj.name)
+                
+                if isinstance(obj, ADFSdirectory):
+                
+                    loads.append(0)
+                    exes.append(0)
+                    lengths.append(0)
+                    filetypes.append(-1)
+                    directories.append(1)
+                    
+                    if obj.address is None:
+                        offsets.append(-1)
+                    else:
+                        offsets.append(obj.address)
+                    
+                    lower.append((path_id, obj.files))
+                
+                else:
+                
+                    loads.append(obj.load_address)
+                    exes.append(obj.execution_address)
+                    lengths.append(obj.length)
+                    
+                    if obj.has_filetype():
+                        filetypes.append((obj.load_address >> 8) & 0xfff)
+                    else:
+                        filetypes.append(-1)
+                    
+                    directories.append(0)
+                    
+                    if obj.extents:
+                        offsets.append(obj.extents[0][0])
+                    else:
+                        offsets.append(-1)
+            
+            # Visit the contents of the first directory found next.
+            lower.reverse()
+            pending.extend(lower)
+        
+        fields = map(lambda (field, typecode): field, catalogue_columns)
+        
+        if use_numpy:
+            numpy = _import_numpy()
+        else:
+            numpy = None
+        
+        if numpy is None:
+        
+            return dict(zip(fields, columns))
+        
+        # Find the length of the longest name so that all names fit in the
+        # array.
+        name_length = max([1] + map(len, names))
+        
+        dtype = []
+        
+        for field, typecode in catalogue_columns:
+        
+            if typecode is None:
+                dtype.append((field, "S%i" % name_length))
+            else:
+                dtype.append((field, numpy.dtype(typecode)))
+        
+        table = numpy.zeros(len(path_ids), dtype = dtype)
         
-        endseq = self.sectors[tail+self.sector_size-6]
-        if endseq != dir_seq:
+        for field, values in zip(fields, columns):
         
-            if self.verify:
-            
-                self.verify_log.append(
-                    ( WARNING,
-                      'Broken directory: %s at [%x, %x]' % \
-                      (dir_title, head, tail) )
-                    )
-            
-            return dir_name, files
+            table[field] = values
         
-        return dir_name, files
+        return table
     
     def print_catalogue(self, files = None, path = "$", filetypes = 0):
     
@@ -1513,10 +3071,14 @@ class ADFSdisc(Utilities):
             
                 self.print_catalogue(obj.files, path + "." + name, filetypes)
     
-    def _extract_old_files(self, objects, path, filetypes = 0, separator = ",",
-                           convert_dict = {}, with_time_stamps = False):
+    def _extract_objects(self, objects, path, filetypes, separator,
+                         convert_dict, write, directories, store):
     
-        new_path = self._create_directory(path)
+        # Create the directory for the objects before any of the files in it
+        # are written, then pass each file to the write function and extract
+        # the contents of each subdirectory.
+        
+        new_path = self._create_directory(path, known = directories)
         
         if new_path != "":
         
@@ -1530,127 +3092,130 @@ class ADFSdisc(Utilities):
         
             old_name = obj.name
             
+            # Use the conversion dictionary to convert any forbidden
+            # characters to accepted local substitutes.
             name = self._convert_name(old_name, convert_dict)
             
             if isinstance(obj, ADFSfile):
             
                 # A file.
-                
-                if not filetypes:
-                
-                    # Load and execution addresses assumed to be valid.
-                    
-                    # Create the INF file
-                    out_file = os.path.join(path, name)
-                    inf_file = os.path.join(path, name) + separator + "inf"
-                    
-                    try:
-                        out = open(out_file, "wb")
-                        out.write(obj.data)
-                        out.close()
-                    except IOError:
-                        print "Couldn't open the file: %s" % out_file
-                    
-                    try:
-                        inf = open(inf_file, "w")
-                        inf.write("$.%s\t%X\t%X\t%X" % (
-                            name, obj.load_address, obj.execution_address,
-                            obj.length
-                            ))
-                        inf.close()
-                    except IOError:
-                        print "Couldn't open the file: %s" % inf_file
-                
-                else:
-                
-                    # Interpret the load address as a filetype.
-                    out_file = os.path.join(path, name) + separator + obj.filetype()
-                    
-                    try:
-                        out = open(out_file, "wb")
-                        out.write(obj.data)
-                        out.close()
-                    except IOError:
-                        print "Couldn't open the file: %s" % out_file
+                write(obj, path, name, filetypes, separator, store)
+            
             else:
             
                 new_path = os.path.join(path, name)
                 
-                self._extract_old_files(
-                    obj.files, new_path, filetypes, separator, convert_dict
+                self._extract_objects(
+                    obj.files, new_path, filetypes, separator, convert_dict,
+                    write, directories, store
                     )
     
-    def _extract_new_files(self, objects, path, filetypes = 0, separator = ",",
-                           convert_dict = {}, with_time_stamps = False):
+    def _write_file(self, obj, path, name, filetypes, separator, store):
     
-        new_path = self._create_directory(path)
+        # Writes the file, obj, to the directory given by path, returning a
+        # list of messages describing any problems encountered.
         
-        if new_path != "":
+        messages = []
         
-            path = new_path
+        if not filetypes:
+        
+            # Load and execution addresses assumed to be valid.
+            
+            # Create the INF file
+            out_file = os.path.join(path, name)
+            inf_file = os.path.join(path, name) + separator + "inf"
+            
+            messages = messages + self._write_data(obj, out_file, store)
+            
+            try:
+                inf = open(inf_file, "w")
+                inf.write(self._inf_text(obj, name))
+                inf.close()
+            except IOError:
+                messages.append("Couldn't open the file: %s" % inf_file)
         
         else:
         
-            return
+            # Interpret the load address as a filetype.
+            out_file = os.path.join(path, name) + separator + obj.filetype()
+            
+            messages = messages + self._write_data(obj, out_file, store)
         
-        for obj in objects:
+        return messages
+    
+    def _write_data(self, obj, out_file, store):
+    
+        if store is not None:
         
-            old_name = obj.name
+            # Let the content store create the file or record it.
+            try:
+                store.add(ADFSfileStream(obj), out_file)
+            except EnvironmentError:
+                return ["Couldn't store the file: %s" % out_file]
             
-            # Use the conversion dictionary to convert any forbidden
-            # characters to accepted local substitutes.
-            name = self._convert_name(old_name, convert_dict)
+            return []
+        
+        try:
+            out = open(out_file, "wb")
+            out.write(obj.data)
+            out.close()
+        except IOError:
+            return ["Couldn't open the file: %s" % out_file]
+        
+        return []
+    
+    def _inf_text(self, obj, name):
+    
+        return "$.%s\t%X\t%X\t%X" % (
+            name, obj.load_address, obj.execution_address, obj.length
+            )
+    
+    def _write_and_report(self, obj, path, name, filetypes, separator, store):
+    
+        for message in self._write_file(obj, path, name, filetypes, separator,
+                                        store):
+            print message
+    
+    def _extract_in_pool(self, objects, path, filetypes, separator,
+                         convert_dict, directories, store, workers):
+        
+        # Walk the catalogue in this thread, creating directories as they are
+        # found, and pass the files to a pool of threads to be written.
+        pool = multiprocessing.pool.ThreadPool(workers)
+        pending = []
+        
+        def write(*arguments):
+        
+            pending.append(pool.apply_async(self._write_file, arguments))
             
-            if isinstance(obj, ADFSfile):
+            # Limit the number of files waiting to be written, reporting any
+            # problems with each file in the order the files were found.
+            if len(pending) > workers * 4:
             
-                # A file.
-                
-                if not filetypes:
-                
-                    # Load and execution addresses assumed to be valid.
-                    
-                    # Create the INF file
-                    out_file = path + os.sep + name
-                    inf_file = path + os.sep + name + separator + "inf"
-                    
-                    try:
-                        out = open(out_file, "wb")
-                        out.write(obj.data)
-                        out.close()
-                    except IOError:
-                        print "Couldn't open the file: %s" % out_file
-                    
-                    try:
-                        inf = open(inf_file, "w")
-                        inf.write("$.%s\t%X\t%X\t%X" % (
-                            name, obj.load_address, obj.execution_address,
-                            obj.length
-                            ))
-                        inf.close()
-                    except IOError:
-                        print "Couldn't open the file: %s" % inf_file
-                else:
-                
-                    # Interpret the load address as a filetype.
-                    out_file = path + os.sep + name + separator + obj.filetype()
-                    
-                    try:
-                        out = open(out_file, "wb")
-                        out.write(obj.data)
-                        out.close()
-                    except IOError:
-                        print "Couldn't open the file: %s" % out_file
-            else:
+                for message in pending.pop(0).get():
+                    print message
+        
+        try:
+        
+            self._extract_objects(
+                objects, path, filetypes, separator, convert_dict, write,
+                directories, store
+                )
             
-                new_path = os.path.join(path, name)
-                
-                self._extract_new_files(
-                    obj.files, new_path, filetypes, separator, convert_dict
-                    )
+            for result in pending:
+            
+                for message in result.get():
+                    print message
+        
+        finally:
+        
+            pool.close()
+            pool.join()
     
     def extract_files(self, out_path, files = None, filetypes = 0,
                       separator = ",", convert_dict = {},
-                      with_time_stamps = False):
+                      with_time_stamps = False, workers = 0,
+                      directories = None, store = None):
     
         """Extracts the files stored in the disc image into a directory
         structure stored on the path specified by out_path.
@@ -1669,39 +3234,152 @@ class ADFSdisc(Utilities):
         
         If with_time_stamps is set, each extracted file will be given the time
         stamp on the target file system that it has in the disc image.
+        
+        If workers is greater than zero, files are written by a pool of that
+        number of threads. Each directory is still created before any of the
+        files in it are written, and problems with each file are reported in
+        the order that the files are found in the catalogue.
+        
+        Directories that are created or found to exist are recorded in a
+        dictionary so that each one is only checked or created once. To share
+        this information between calls, such as when extracting many discs
+        into the same directory structure, pass an empty dictionary as the
+        directories argument and reuse it for each call. The dictionary must
+        not be reused if directories are removed between calls.
+        
+        If store is an ADFScontentStore instance, the contents of each file
+        are hashed as they are extracted and only stored once in the store,
+        with each extracted file either linked to the stored contents or
+        recorded in the store's manifest. The same store can be used for many
+        discs; call its report() method afterwards for a summary.
         """
         
         if files is None:
         
             files = self.files
         
-        if self.disc_type == 'adD':
+        if directories is None:
         
-            self._extract_old_files(
-                files, out_path, filetypes, separator, convert_dict,
-                with_time_stamps
-                )
+            directories = {}
         
-        elif self.disc_type == 'adE':
+        start = time.time()
+        
+        if workers > 0:
         
-            self._extract_new_files(
+            self._extract_in_pool(
                 files, out_path, filetypes, separator, convert_dict,
-                with_time_stamps
+                directories, store, workers
                 )
         
-        elif self.disc_type == 'adEbig':
+        else:
         
-            self._extract_new_files(
+            self._extract_objects(
                 files, out_path, filetypes, separator, convert_dict,
-                with_time_stamps
+                self._write_and_report, directories, store
                 )
         
+        self._count("extract time", time.time() - start)
+    
+    def _archive_objects(self, objects, path, filetypes, separator,
+                         convert_dict, archive):
+        
+        for obj in objects:
+        
+            old_name = obj.name
+            
+            # Use the conversion dictionary to convert any forbidden
+            # characters to accepted local substitutes.
+            name = self._convert_name(old_name, convert_dict)
+            
+            if path != "":
+                member = path + "/" + name
+            else:
+                member = name
+            
+            if isinstance(obj, ADFSfile):
+            
+                stream = ADFSfileStream(obj)
+                
+                time_stamp = ()
+                if obj.has_filetype():
+                    time_stamp = obj.time_stamp()
+                
+                if time_stamp != ():
+                    mtime = time.mktime(time_stamp)
+                else:
+                    mtime = time.time()
+                
+                if not filetypes:
+                
+                    # Load and execution addresses assumed to be valid.
+                    archive.add_file(member, stream, stream.length, mtime)
+                    
+                    # Add the INF file
+                    inf = self._inf_text(obj, name)
+                    archive.add_file(
+                        member + separator + "inf", io.BytesIO(inf), len(inf),
+                        mtime
+                        )
+                
+                else:
+                
+                    # Interpret the load address as a filetype.
+                    archive.add_file(
+                        member + separator + obj.filetype(), stream,
+                        stream.length, mtime
+                        )
+            
+            else:
+            
+                archive.add_directory(member, time.time())
+                
+                self._archive_objects(
+                    obj.files, member, filetypes, separator, convert_dict,
+                    archive
+                    )
+    
+    def extract_to_archive(self, fileobj, format = "tar", files = None,
+                           filetypes = 0, separator = ",", convert_dict = {},
+                           path = ""):
+        
+        """Writes the files stored in the disc image to an archive of the
+        given format, either "tar" or "zip", using the file object supplied.
+        The file object does not need to be seekable, so the archive can be
+        written to a pipe, and it is not closed afterwards.
+        
+        The files, filetypes, separator and convert_dict parameters have the
+        same meanings as for the extract_files() method, and the same names
+        and INF files are used for the files in the archive. If path is not
+        an empty string, all the files are stored in the directory it
+        specifies within the archive.
+        
+        Files are read from the disc image as they are written to tar
+        archives. Files with time stamps are given those times in the archive.
+        """
+        
+        if files is None:
+        
+            files = self.files
+        
+        if format == "tar":
+            archive = ADFStarWriter(fileobj)
+        elif format == "zip":
+            archive = ADFSzipWriter(fileobj)
         else:
+            raise ADFS_exception, "Unknown archive format: %s" % format
         
-            self._extract_old_files(
-                files, out_path, filetypes, separator, convert_dict,
-                with_time_stamps
+        try:
+        
+            if path != "":
+                archive.add_directory(path, time.time())
+            
+            self._archive_objects(
+                files, path, filetypes, separator, convert_dict, archive
                 )
+        
+        finally:
+        
+            archive.close()
     
     def print_log(self, verbose = 0):
     
@@ -1736,6 +3414,293 @@ class ADFSdisc(Utilities):
         
             print line
     
+    def free_space_map(self):
+    
+        """Returns the map describing the allocation of space on the disc:
+        an ADFSnewMap instance for E and F format discs, or an ADFSoldMap
+        instance for other formats. Its allocation_bitmap(), free_runs(),
+        free_run_histogram() and fragment_counts() methods describe the use
+        of space and the fragmentation of the disc.
+        """
+        
+        if self.disc_type in ('adE', 'adEbig'):
+            return self.disc_map
+        
+        return ADFSoldMap(self.sectors)
+    
+    def usage(self):
+    
+        """Returns a dictionary describing the use of space on the disc,
+        obtained from its map, containing the disc size, the numbers of bytes
+        used and free, the number of free runs and the length of the largest
+        free run in bytes.
+        """
+        
+        return self.free_space_map().usage()
+    
     def disc_format(self):
     
         return self._format_names[self.disc_type]
+
+
+class ADFSprobe(Utilities):
+
+    """probe = ADFSprobe(adf)
+    
+    Identifies the format of the disc image accessed by the file object, adf,
+    by reading only the parts of the image needed to do so: its length, any
+    disc record and the markers of its root directory.
+    
+    The format is recorded in the disc_type attribute, using the same values
+    as the disc_type attribute of ADFSdisc, or None if the image is not
+    recognised. The disc's name is recorded in the disc_name attribute and
+    the fraction of the format's checks that were passed is recorded in the
+    confidence attribute as a number between 0.0 and 1.0. Images which pass
+    less than min_probe_confidence of the checks are not recognised.
+    """
+    
+    def __init__(self, adf):
+    
+        self.adf = adf
+        self.disc_type = None
+        self.disc_name = ''
+        self.confidence = 0.0
+        
+        adf.seek(0, 2)
+        self.length = adf.tell()
+        
+        if self.length in (163840, 327680):
+        
+            if self.length == 163840:
+                self.disc_type = 'ads'
+            else:
+                self.disc_type = 'adm'
+            
+            self._probe_old_format()
+        
+        elif self.length == 655360:
+        
+            # The root directory is in the first track so it is found at the
+            # same offset in interleaved and sequenced images.
+            self.disc_type = 'adl'
+            self._probe_old_format()
+        
+        elif self.length == 819200:
+        
+            self._probe_800K_format()
+        
+        elif self.length == 1638400:
+        
+            self.disc_type = 'adEbig'
+            self._probe_new_format(0xc6804, "quad", 0xc8800)
+        
+        if self.confidence < min_probe_confidence:
+            self.disc_type = None
+    
+    def _read(self, offset, length):
+    
+        # Offsets calculated from damaged disc records can lie outside the
+        # image, or be too large to seek to, so nothing is read for them.
+        if offset < 0 or offset + length > self.length:
+            return ""
+        
+        self.adf.seek(offset, 0)
+        return self.adf.read(length)
+    
+    def _score(self, checks):
+    
+        return float(reduce(lambda a, b: a + b, checks, 0)) / len(checks)
+    
+    def _probe_old_format(self):
+    
+        # The root directory is five sectors long and starts at 0x200.
+        directory = self._read(0x200, 0x500)
+        
+        self.confidence = self._score(
+            [directory[1:5] == 'Hugo', directory[-5:-1] == 'Hugo']
+            )
+        
+        self.disc_name = self._safe(self._safe(directory[-39:-20]),
+                                    with_space = 1)
+    
+    def _probe_800K_format(self):
+    
+        # Use the same criteria as ADFSdisc to decide between D and E format.
+        checks = self._check_disc_record(4, "double")
+        
+        root = self.record["root dir"] * self.record["sector size"]
+        checks.append(self._read(root + 1, 4) in ("Hugo", "Nick"))
+        
+        if self._score(checks) == 1.0:
+        
+            self.disc_type = 'adE'
+            self.confidence = 1.0
+            self.disc_name = self._safe(self.record['disc name'], with_space = 1)
+            return
+        
+        word1 = self._read(0x401, 4)
+        word2 = self._read(0x801, 4)
+        
+        if word1 == 'Hugo' or word1 == 'Nick':
+        
+            # The root directory is two sectors long and starts at 0x400.
+            self.disc_type = 'adD'
+            
+            directory = self._read(0x400, 0x800)
+            
+            self.confidence = self._score(
+                [1, directory[-5:-1] == word1]
+                )
+            self.disc_name = self._safe(directory[-35:-16], with_space = 1)
+        
+        elif word2 == 'Nick':
+        
+            self.disc_type = 'adE'
+            self._probe_new_format(4, "double", 0x800)
+    
+    def _probe_new_format(self, offset, density, root):
+    
+        checks = self._check_disc_record(offset, density)
+        
+        # Check for a directory at the usual location of the root directory.
+        checks.append(self._read(root + 1, 4) == 'Nick')
+        
+        self.confidence = self._score(checks)
+        self.disc_name = self._safe(self.record['disc name'], with_space = 1)
+    
+    def _check_disc_record(self, offset, density):
+    
+        # Only the disc record itself is read from the image.
+        self.sectors = self._read(offset, 60)
+        self.record = record = self._read_disc_record(0)
+        
+        return [record["disc size"] == self.length,
+                record["sector size"] == 1024,
+                record["density"] == density,
+                8 <= record["log2 sector size"] <= 10]
+
+
+def probe(adf):
+
+    """disc_type, disc_name, confidence = probe(adf)
+    
+    Identifies the format of a disc image without reading its catalogue,
+    where adf is either the path to the disc image or a file object used to
+    access it. The position of a file object is restored afterwards.
+    
+    Returns the disc type (using the same values as the disc_type attribute
+    of ADFSdisc) or None if the image is not recognised, the disc name and a
+    number between 0.0 and 1.0 indicating the fraction of the checks for the
+    format that were passed.
+    """
+    
+    if isinstance(adf, basestring):
+    
+        f = open(adf, "rb")
+        try:
+            p = ADFSprobe(f)
+        finally:
+            f.close()
+    
+    else:
+    
+        position = adf.tell()
+        try:
+            p = ADFSprobe(adf)
+        finally:
+            adf.seek(position, 0)
+    
+    return p.disc_type, p.disc_name, p.confidence
+
+
+def usage(adf):
+
+    """usage = usage(adf)
+    
+    Returns a dictionary describing the use of space on a disc image, in the
+    same form as the usage() method of ADFSdisc, without reading its
+    catalogue. Only the parts of the image needed to identify its format and
+    its map are read. adf is either the path to the disc image or a file
+    object used to access it; the position of a file object is restored
+    afterwards.
+    
+    If the image is not recognised, or its disc record describes a map which
+    does not fit in the image, an ADFS_exception is raised.
+    """
+    
+    return read_map(adf).usage()
+
+
+def read_map(adf):
+
+    """map = read_map(adf)
+    
+    Returns the map of a disc image, as an ADFSnewMap instance for E and F
+    format discs or an ADFSoldMap instance for other formats, without
+    reading its catalogue. adf is either the path to the disc image or a file
+    object used to access it; the position of a file object is restored
+    afterwards.
+    
+    If the image is not recognised, or its disc record describes a map which
+    does not fit in the image, an ADFS_exception is raised.
+    """
+    
+    if isinstance(adf, basestring):
+    
+        f = open(adf, "rb")
+        try:
+            return _read_map(f)
+        finally:
+            f.close()
+    
+    else:
+    
+        position = adf.tell()
+        try:
+            return _read_map(adf)
+        finally:
+            adf.seek(position, 0)
+
+
+def _read_map(adf):
+
+    p = ADFSprobe(adf)
+    
+    if p.disc_type is None:
+    
+        raise ADFS_exception, 'Unrecognised disc image.'
+    
+    elif p.disc_type in ('adE', 'adEbig'):
+    
+        # Read the zones of the map, which start at the same offset as the
+        # disc record.
+        record = p.record
+        
+        if p.disc_type == 'adE':
+            header = 0
+        else:
+            header = 0xc6800
+        
+        # Check the fields used to decode the map against the image so that
+        # a damaged record cannot cause the whole disc to be described.
+        zones = max(1, record["zones"])
+        sector_size = record["sector size"]
+        
+        if not 8 <= record["log2 sector size"] <= 10 or \
+            not 0 < record["disc size"] <= p.length or \
+            header + (zones * sector_size) > p.length or \
+            not 0 < record["idlen"] <= 21 or \
+            record["zone spare"] >= sector_size * 8 or \
+            record["log2 bytes per bit"] > 12:
+            
+            raise ADFS_exception, 'Invalid disc record in disc image.'
+        
+        data = p._read(header, zones * sector_size)
+        return ADFSnewMap(0, 0x40, len(data), data, record["sector size"],
+                          record)
+    
+    else:
+    
+        # The map occupies the first two sectors of old format discs and is
+        # in the first track of interleaved images.
+        return ADFSoldMap(p._read(0, 0x200))
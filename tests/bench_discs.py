@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+"""
+Times the construction of ADFSdisc instances, print_catalogue and
+extract_files for synthetic disc images of each format and several sizes,
+so that changes to the parsers can be measured repeatably without needing
+real disc images.
+"""
+
+import ADFSlib
+import make_images
+import io, os, shutil, sys, tempfile, time
+
+formats = ["ads", "adm", "adl", "adD", "adE", "adEbig"]
+
+# Ways of passing images to ADFSdisc.from_buffer.
+buffer_types = {"str": str, "bytearray": bytearray, "memoryview": memoryview}
+
+
+class NullOutput:
+
+    def write(self, text):
+        pass
+
+
+def best_time(function, repeats):
+
+    # Return the best time taken to call the function.
+    best = None
+    for i in range(repeats):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def open_disc(image, options, buffer_type = None):
+
+    if buffer_type is not None:
+        return ADFSlib.ADFSdisc.from_buffer(buffer_types[buffer_type](image),
+                                            **options)
+    return ADFSlib.ADFSdisc(io.BytesIO(image), **options)
+
+
+def list_disc(disc):
+
+    # Discard the catalogue listing.
+    stdout = sys.stdout
+    sys.stdout = NullOutput()
+    try:
+        disc.print_catalogue()
+    finally:
+        sys.stdout = stdout
+
+
+def extract_disc(disc, options):
+
+    out_path = tempfile.mkdtemp()
+    stdout = sys.stdout
+    sys.stdout = NullOutput()
+    try:
+        disc.extract_files(os.path.join(out_path, "disc"), **options)
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(out_path)
+
+
+def benchmark(disc_type, files, depth, fragmentation, defects, repeats,
+              options, buffer_type = None):
+    
+    try:
+        image = make_images.make_image(disc_type, files, depth, fragmentation,
+                                       defects)
+    except ValueError:
+        # The files do not fit on a disc of this format.
+        return None
+    
+    open_time = best_time(lambda: open_disc(image, options, buffer_type),
+                          repeats)
+    
+    disc = open_disc(image, options, buffer_type)
+    list_time = best_time(lambda: list_disc(disc), repeats)
+    extract_time = best_time(lambda: extract_disc(disc, {}), repeats)
+    
+    return open_time, list_time, extract_time
+
+
+if __name__ == "__main__":
+
+    sizes = [10, 50, 200]
+    depth = 3
+    fragmentation = 0
+    defects = 0
+    repeats = 5
+    options = {}
+    buffer_type = None
+    cache_dir = None
+    
+    args = sys.argv[1:]
+    
+    while args:
+    
+        arg = args.pop(0)
+        
+        if arg == "--sizes":
+            sizes = map(int, args.pop(0).split(","))
+        elif arg == "--formats":
+            formats = args.pop(0).split(",")
+        elif arg == "--depth":
+            depth = int(args.pop(0))
+        elif arg == "--fragmentation":
+            fragmentation = int(args.pop(0))
+        elif arg == "--defects":
+            defects = int(args.pop(0))
+        elif arg == "--repeats":
+            repeats = int(args.pop(0))
+        elif arg == "--lazy":
+            options["lazy"] = 1
+        elif arg == "--buffer" and args and buffer_types.has_key(args[0]):
+            buffer_type = args.pop(0)
+        elif arg == "--cache":
+            cache_dir = tempfile.mkdtemp()
+            options["cache_dir"] = cache_dir
+        else:
+            sys.stderr.write(
+                "Usage: %s [--sizes n,n,...] [--formats f,f,...] "
+                "[--depth n] [--fragmentation n] [--defects n] "
+                "[--repeats n] [--lazy] [--buffer str|bytearray|memoryview] "
+                "[--cache]\n" % sys.argv[0]
+                )
+            sys.exit(1)
+    
+    print "%-7s %6s %10s %10s %13s" % ("format", "files", "open (ms)",
+                                       "list (ms)", "extract (ms)")
+    
+    for disc_type in formats:
+    
+        for files in sizes:
+        
+            times = benchmark(disc_type, files, depth, fragmentation, defects,
+                              repeats, options, buffer_type)
+            
+            if times is None:
+                print "%-7s %6i %10s %10s %13s" % (disc_type, files, "-", "-",
+                                                   "-")
+                continue
+            
+            open_time, list_time, extract_time = times
+            print "%-7s %6i %10.3f %10.3f %13.3f" % (
+                disc_type, files, open_time * 1000, list_time * 1000,
+                extract_time * 1000
+                )
+    
+    if cache_dir is not None:
+        shutil.rmtree(cache_dir)
+    
+    sys.exit()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+"""
+Times the decoding of directory entries and disc records in ADFSlib by
+repeatedly reading the root directory of synthetic disc images which are
+filled with files, reporting the cost of decoding each entry. The fields of
+the entries and disc records are also decoded using both the struct layouts
+used by ADFSlib and a reference implementation of the earlier decoder, which
+read each field from its own slice of the image, and the results are checked
+to be identical and the times compared.
+"""
+
+import ADFSlib
+import make_images
+import string, sys, time
+
+formats = ["ads", "adm", "adl", "adD", "adE", "adEbig"]
+
+
+def root_address(disc):
+
+    # Return the offset of the root directory in the disc image.
+    if disc.disc_type == "adE":
+        return 2 * disc.sector_size
+    elif disc.disc_type == "adEbig":
+        return (disc.ntracks * disc.nsectors/2 + 2) * disc.sector_size
+    elif disc.disc_type == "adD":
+        return 0x400
+    else:
+        return 2 * disc.sector_size
+
+
+def entry_offsets(directory):
+
+    # Return the offsets of the entries in the directory, which start after
+    # the directory's sequence number and marker and end with a zero byte.
+    offsets = []
+    p = 5
+    while p + 26 <= len(directory) and ord(directory[p]) != 0:
+        offsets.append(p)
+        p = p + 26
+    return offsets
+
+
+def old_entries(utilities, directory, offsets):
+
+    # Decode each entry by slicing out each field, as the earlier decoder
+    # did, including the search for characters with their top bits set.
+    entries = []
+    for p in offsets:
+        old_name = directory[p:p+10]
+        top_set = 0
+        counter = 1
+        for i in old_name:
+            if (ord(i) & 128) != 0:
+                top_set = counter
+            counter = counter + 1
+        name = utilities._safe(directory[p:p+10])
+        load = utilities._read_unsigned_word(directory[p+10:p+14])
+        exe = utilities._read_unsigned_word(directory[p+14:p+18])
+        length = utilities._read_unsigned_word(directory[p+18:p+22])
+        address = utilities._str2num(3, directory[p+22:p+25])
+        atts = utilities._read_unsigned_byte(directory[p+25])
+        entries.append((name, load, exe, length, address, atts))
+    return entries
+
+
+def new_entries(utilities, directory, offsets):
+
+    # Decode each entry with the struct layout used by ADFSlib.
+    entries = []
+    for p in offsets:
+        old_name, load, exe, length, address_low, address_high, atts = \
+            ADFSlib._directory_entry.unpack_from(directory, p)
+        entries.append((utilities._safe(old_name), load, exe, length,
+                        address_low | (address_high << 16), atts))
+    return entries
+
+
+def old_disc_record(utilities, sectors, offset):
+
+    # Read the fields of the disc record one at a time, as the earlier
+    # decoder did.
+    log2_sector_size = ord(sectors[offset])
+    nsectors = ord(sectors[offset + 1])
+    heads = ord(sectors[offset + 2])
+    density = ord(sectors[offset + 3])
+    
+    if density == 1:
+        density = 'single'
+    elif density == 2:
+        density = 'double'
+    elif density == 3:
+        density = 'quad'
+    else:
+        density = 'unknown'
+    
+    idlen = utilities._read_unsigned_byte(sectors[offset + 4])
+    log2_bytes_per_bit = utilities._read_unsigned_byte(sectors[offset + 5])
+    bytes_per_bit = 2 ** log2_bytes_per_bit
+    zones = ord(sectors[offset + 9])
+    zone_spare = utilities._read_unsigned_half_word(
+        sectors[offset + 10 : offset + 12])
+    root = utilities._str2num(3, sectors[offset + 13 : offset + 16])
+    disc_size = utilities._read_unsigned_word(sectors[offset + 16 : offset + 20])
+    disc_id = utilities._read_unsigned_half_word(
+        sectors[offset + 20 : offset + 22])
+    disc_name = string.strip(sectors[offset + 22 : offset + 32])
+    disc_size = disc_size | (utilities._read_unsigned_word(
+        sectors[offset + 36 : offset + 40]) << 32)
+    zones = zones | (ord(sectors[offset + 42]) << 8)
+    
+    return {'sectors': nsectors, 'log2 sector size': log2_sector_size,
+        'sector size': 2**log2_sector_size, 'heads': heads,
+        'density': density, 'idlen': idlen,
+        'log2 bytes per bit': log2_bytes_per_bit,
+        'bytes per bit': bytes_per_bit, 'zone spare': zone_spare,
+        'disc size': disc_size, 'disc ID': disc_id,
+        'disc name': disc_name, 'zones': zones, 'root dir': root }
+
+
+def root_reader(disc):
+
+    # Return a function which reads the root directory of the disc again.
+    address = root_address(disc)
+    if disc.disc_type in ("adE", "adEbig"):
+        return lambda: disc.disc_map.read_catalogue(address)
+    else:
+        return lambda: disc._read_old_catalogue(address)
+
+
+def best_time(function, count, repeats = 5):
+
+    # Return the best time taken to call the function the given number of
+    # times.
+    best = None
+    for i in range(repeats):
+        start = time.time()
+        for j in xrange(count):
+            function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    else:
+        count = 200
+    
+    print "%-8s %8s %12s %16s %12s %12s %8s" % (
+        "format", "entries", "total (ms)", "per entry (us)", "old (us)",
+        "struct (us)", "speedup")
+    
+    for disc_type in formats:
+    
+        # Fill the root directory with files.
+        if disc_type in ("ads", "adm", "adl"):
+            files = make_images.old_dir_entries
+        else:
+            files = make_images.new_dir_entries
+        data = make_images.make_image(disc_type, files, 0)
+        disc = ADFSlib.ADFSdisc(ADFSlib.io.BytesIO(data))
+        
+        read = root_reader(disc)
+        before = disc.stats["entries decoded"]
+        read()
+        entries = disc.stats["entries decoded"] - before
+        
+        # Only measure the decoding of entries.
+        disc.stats = None
+        if hasattr(disc, "disc_map"):
+            disc.disc_map.stats = None
+        
+        elapsed = best_time(read, count)
+        
+        # Compare the decoding of the fields of the same entries.
+        head = root_address(disc)
+        directory = disc.sectors[head:head + 5 * 256 + 26 * files]
+        offsets = entry_offsets(directory)
+        
+        if old_entries(disc, directory, offsets) != \
+            new_entries(disc, directory, offsets):
+            
+            sys.stderr.write("Entries decoded differently for %s\n" %
+                             disc_type)
+            sys.exit(1)
+        
+        old = best_time(lambda: old_entries(disc, directory, offsets), count)
+        new = best_time(lambda: new_entries(disc, directory, offsets), count)
+        
+        print "%-8s %8i %12.3f %16.3f %12.3f %12.3f %8.2f" % (
+            disc_type, entries, elapsed * 1000 / count,
+            elapsed * 1000000 / (count * entries),
+            old * 1000000 / (count * len(offsets)),
+            new * 1000000 / (count * len(offsets)), old / new
+            )
+    
+    # Time the decoding of disc records.
+    data = make_images.make_image("adE", 1, 0)
+    disc = ADFSlib.ADFSdisc(ADFSlib.io.BytesIO(data))
+    
+    if old_disc_record(disc, disc.sectors, 4) != disc._read_disc_record(4):
+        sys.stderr.write("Disc record decoded differently\n")
+        sys.exit(1)
+    
+    elapsed = best_time(lambda: disc._read_disc_record(4), count * 50)
+    old = best_time(lambda: old_disc_record(disc, disc.sectors, 4), count * 50)
+    print
+    print "disc record: %.3f us (old decoder %.3f us, speedup %.2f)" % (
+        elapsed * 1000000 / (count * 50), old * 1000000 / (count * 50),
+        old / elapsed)
+    
+    sys.exit()
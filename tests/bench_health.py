@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+"""
+Times the production of disc health reports from the maps of synthetic disc
+images using ADFSlib.read_map, which does not read the catalogue: the
+allocation bitmap, free runs, free run histogram and fragment counts.
+"""
+
+import ADFSlib
+import make_images
+import io, sys, time
+
+formats = ["ads", "adm", "adl", "adD", "adE", "adEbig"]
+
+
+def report(data):
+
+    disc_map = ADFSlib.read_map(io.BytesIO(data))
+    bitmap = disc_map.allocation_bitmap()
+    starts, lengths = disc_map.free_runs(bitmap)
+    histogram = disc_map.free_run_histogram(lengths)
+    ids, counts = disc_map.fragment_counts()
+    return disc_map, lengths, histogram, counts
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        repeats = int(sys.argv[1])
+    else:
+        repeats = 100
+    
+    print "%-8s %6s %6s %10s %10s %12s" % (
+        "format", "units", "runs", "largest", "max frags", "report (ms)")
+    
+    for disc_type in formats:
+    
+        data = make_images.make_image(disc_type, 30, 2, 2, 3)
+        
+        start = time.time()
+        for i in range(repeats):
+            disc_map, lengths, histogram, counts = report(data)
+        elapsed = (time.time() - start) / repeats
+        
+        print "%-8s %6i %6i %10i %10i %12.3f" % (
+            disc_type, len(disc_map.allocation_bitmap()), len(lengths),
+            max([0] + list(lengths)), max([0] + list(counts)),
+            elapsed * 1000)
+    
+    sys.exit()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""
+Times the new map decoder in ADFSlib on synthetic maps with different
+fragment number lengths, bytes per map bit and numbers of zones, including
+corrupt maps made of random bits and maps whose fragments are never
+terminated, to show that the time taken grows linearly with the size of the
+map even in the worst case.
+"""
+
+import ADFSlib
+import random, sys, time
+
+sector_size = 1024
+zone_spare = 32
+
+# (name, fragment number length, log2 bytes per map bit)
+layouts = [("floppy", 15, 6), ("hard disc", 19, 10), ("big disc", 21, 12)]
+
+
+def fill(bits, layout, pattern, rng):
+
+    # Return a string of bits, represented as "0" and "1" characters, made
+    # from the pieces of map produced by the pattern.
+    name, idlen, log2_bpmb = layout
+    data = ""
+    while len(data) < bits:
+        data = data + pattern(idlen, rng)
+    return data[:bits]
+
+
+def fragment(idlen, length, rng):
+
+    # Return the bits of a fragment with a random fragment number which is
+    # at least as long as the fragment number.
+    frag_id = rng.randint(3, (1 << idlen) - 1)
+    return "".join(map(lambda i: str((frag_id >> i) & 1), range(idlen))) + \
+           ("0" * (length - idlen - 1)) + "1"
+
+
+def dense(idlen, rng):
+
+    # Fragments which only contain a fragment number.
+    return fragment(idlen, idlen + 1, rng)
+
+
+def short(idlen, rng):
+
+    return fragment(idlen, idlen + 1 + rng.randint(0, 64), rng)
+
+
+def long(idlen, rng):
+
+    # Fragments which extend over most of a zone.
+    return fragment(idlen, rng.randint(4000, 7000), rng)
+
+
+def noise(idlen, rng):
+
+    # Random bits, as found in a corrupt map.
+    return "".join(map(lambda i: rng.choice("01"), range(64)))
+
+
+def unterminated(idlen, rng):
+
+    # A fragment number followed by zero bits which never end the fragment,
+    # so that the decoder searches to the end of the zone.
+    return fragment(idlen, idlen + 1, rng)[:idlen] + "0" * 8192
+
+
+patterns = [("dense", dense), ("short", short), ("long", long),
+            ("random", noise), ("no end", unterminated)]
+
+
+def to_bytes(bits):
+
+    data = ""
+    for i in range(0, len(bits), 8):
+        data = data + chr(int(bits[i:i + 8][::-1], 2))
+    return data
+
+
+def make_map(zones, layout, pattern, seed = 0):
+
+    rng = random.Random(seed)
+    zone_bits = (sector_size * 8) - zone_spare
+    data = ""
+    for zone in range(zones):
+        if zone == 0:
+            start_bit = 32 + ADFSlib.disc_record_bits
+        else:
+            start_bit = 32
+        # No free space is recorded in the zone and the disc record is
+        # left empty, except in corrupt maps where the zone header is also
+        # random so that the decoder follows meaningless free space links.
+        if pattern is noise:
+            header = pattern(layout[1], rng)[:32]
+        else:
+            header = "0" * 32
+        bits = header + ("0" * (start_bit - 32)) + \
+               fill(32 + zone_bits - start_bit, layout, pattern, rng)
+        bits = bits + "0" * ((sector_size * 8) - len(bits))
+        data = data + to_bytes(bits)
+    return data
+
+
+def make_record(zones, layout):
+
+    name, idlen, log2_bpmb = layout
+    zone_bits = (sector_size * 8) - zone_spare
+    units = (zones * zone_bits) - ADFSlib.disc_record_bits
+    return {"idlen": idlen, "log2 bytes per bit": log2_bpmb, "zones": zones,
+            "zone spare": zone_spare, "disc size": units << log2_bpmb}
+
+
+def time_map(data, record, repeats = 3):
+
+    # Return the best time taken to decode the map.
+    best = None
+    for i in range(repeats):
+        start = time.time()
+        ADFSlib.ADFSnewMap(0, 0x40, record["zones"] * sector_size, data,
+                           sector_size, record)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        sizes = map(int, sys.argv[1:])
+    else:
+        sizes = [1, 4, 16, 64]
+    
+    print "%-10s %-10s %6s %12s %14s" % ("layout", "pattern", "zones",
+                                         "total (ms)", "per zone (ms)")
+    
+    for layout in layouts:
+    
+        for name, pattern in patterns:
+        
+            for zones in sizes:
+            
+                data = make_map(zones, layout, pattern)
+                record = make_record(zones, layout)
+                elapsed = time_map(data, record)
+                print "%-10s %-10s %6i %12.3f %14.4f" % (
+                    layout[0], name, zones, elapsed * 1000,
+                    elapsed * 1000 / zones
+                    )
+    
+    sys.exit()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+Measures the memory used by the catalogue objects that ADFSlib creates for
+synthetic disc images, reporting the size of each ADFSfile and ADFSdirectory
+instance and the growth of the process when the catalogues of many discs are
+held at once. The same measurements are made for copies of the classes
+without __slots__, which keep their attributes in instance dictionaries, so
+that the memory saved by using __slots__ can be compared.
+"""
+
+import ADFSlib
+import make_images
+import io, multiprocessing, resource, sys
+
+
+def without_slots(cls):
+
+    # Return a class with the same methods and properties as the given class
+    # which stores its attributes in an instance dictionary.
+    namespace = {}
+    for name, value in vars(cls).items():
+        if name not in cls.__slots__ and name not in ("__slots__", "__dict__"):
+            namespace[name] = value
+    return type(cls.__name__, (object,), namespace)
+
+
+# The classes used for each catalogue layout: (directory class, file class).
+layouts = {
+    "slots": (ADFSlib.ADFSdirectory, ADFSlib.ADFSfile),
+    "dict": (without_slots(ADFSlib.ADFSdirectory),
+             without_slots(ADFSlib.ADFSfile))
+    }
+
+
+def load_objects(items, layout, sectors):
+
+    # Create the catalogue objects described by items, as returned by the
+    # ADFSdisc._dump_objects method, using the classes for the layout.
+    directory_class, file_class = layouts[layout]
+    objects = []
+    
+    for item in items:
+    
+        if len(item) == 3:
+            name, address, lower_items = item
+            objects.append(directory_class(
+                name, load_objects(lower_items, layout, sectors), address))
+        else:
+            name, load, exe, length, extents, addr = item
+            objects.append(file_class(name, None, load, exe, length, extents,
+                                      sectors, addr))
+    
+    return objects
+
+
+def instance_size(obj):
+
+    # Include the instance dictionary, if there is one, in the size.
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size = size + sys.getsizeof(obj.__dict__)
+    return size
+
+
+def walk(objects):
+
+    # Return the number of objects in the catalogue and their total size.
+    count = 0
+    size = 0
+    for obj in objects:
+        count = count + 1
+        size = size + instance_size(obj)
+        if hasattr(obj, "files"):
+            lower_count, lower_size = walk(obj.files)
+            count = count + lower_count
+            size = size + lower_size
+    return count, size
+
+
+def max_rss():
+
+    # The maximum resident set size in bytes (reported in kilobytes on Linux).
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def growth(layout):
+
+    # Hold the catalogues of many discs which share the same image data so
+    # that only the catalogue objects account for the growth in memory. This
+    # is run in a new process for each layout so that memory freed by one
+    # measurement is not reused by the next.
+    discs = []
+    before = max_rss()
+    for i in range(copies):
+        discs.append(load_objects(items, layout, disc.sectors))
+    return max_rss() - before
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        copies = int(sys.argv[1])
+    else:
+        copies = 1000
+    
+    data = make_images.make_image("adEbig", 300, 3)
+    
+    disc = ADFSlib.ADFSdisc(io.BytesIO(data))
+    items = disc._dump_objects(disc.files)
+    
+    print "%-24s %14s %12s" % ("", "without slots", "with slots")
+    
+    sizes = {}
+    for layout in ("dict", "slots"):
+        entries, size = walk(load_objects(items, layout, disc.sectors))
+        sizes[layout] = float(size) / entries
+    
+    print "%-24s %14i" % ("Entries per disc:", entries)
+    print "%-24s %14.1f %12.1f" % ("Instance bytes per entry:", sizes["dict"],
+                                   sizes["slots"])
+    
+    pool = multiprocessing.Pool(1, maxtasksperchild = 1)
+    process = {}
+    for layout in ("dict", "slots"):
+        process[layout] = float(pool.apply(growth, (layout,))) / \
+                          (entries * copies)
+    pool.close()
+    pool.join()
+    
+    print "%-24s %14i" % ("Catalogues held:", copies)
+    print "%-24s %14.1f %12.1f" % ("Process bytes per entry:", process["dict"],
+                                   process["slots"])
+    print
+    print "Instance size ratio:      %.2f" % (sizes["dict"] / sizes["slots"])
+    print "Process growth ratio:     %.2f" % (
+        process["dict"] / process["slots"])
+    
+    sys.exit()
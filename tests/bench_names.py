@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""
+Times the decoding of file names from directory entries and the conversion
+of names for the host filing system in ADFSlib, using a catalogue of random
+names that include characters with their top bits set. The names are also
+decoded and converted by a reference implementation of the earlier methods,
+which handled names one character at a time, and the results are checked to
+be identical and the times compared.
+"""
+
+import ADFSlib
+import random, sys, time
+
+
+def make_names(count, seed = 0):
+
+    # Return raw ten character names like those stored in directories, with
+    # some top bits set and some names ended early by a control character.
+    rng = random.Random(seed)
+    names = []
+    for i in range(count):
+        length = rng.randint(1, 10)
+        name = ""
+        for j in range(length):
+            c = rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789!/_")
+            if rng.random() < 0.2:
+                c = chr(ord(c) | 0x80)
+            name = name + c
+        if length < 10:
+            name = name + "\r" + "\x00" * (9 - length)
+        names.append(name)
+    return names
+
+
+def old_safe(s, with_space = 0):
+
+    # The earlier character loop used to decode names.
+    new = ""
+    if with_space == 1:
+        lower = 31
+    else:
+        lower = 32
+    
+    for i in s:
+    
+        if ord(i) <= lower:
+            break
+        
+        if ord(i) >= 128:
+            c = ord(i)^128
+            if c > 32:
+                new = new + chr(c)
+        else:
+            new = new + i
+    
+    return new
+
+
+def old_convert_name(old_name, convert_dict):
+
+    # The earlier character loop used to convert names.
+    name = ""
+    
+    for c in old_name:
+    
+        if c in convert_dict.keys():
+            name = name + convert_dict[c]
+        else:
+            name = name + c
+    
+    return name
+
+
+def best_time(function, repeats = 5):
+
+    best = None
+    for i in range(repeats):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    else:
+        count = 10000
+    
+    utilities = ADFSlib.Utilities()
+    utilities.verify = 0
+    
+    names = make_names(count)
+    safe_names = map(utilities._safe, names)
+    
+    # Conversions which replace each character with one character, which
+    # use a translation table, and with several, which do not.
+    conversions = [("one to one", {"/": ".", "!": "_"}),
+                   ("one to many", {"/": ".", "!": "__"})]
+    
+    # Check that both implementations give the same results.
+    for with_space in (0, 1):
+        if map(lambda name: utilities._safe(name, with_space), names) != \
+            map(lambda name: old_safe(name, with_space), names):
+            sys.stderr.write("Names decoded differently\n")
+            sys.exit(1)
+    
+    for label, convert_dict in conversions:
+        if map(lambda name: utilities._convert_name(name, convert_dict),
+               safe_names) != \
+            map(lambda name: old_convert_name(name, convert_dict), safe_names):
+            sys.stderr.write("Names converted differently (%s)\n" % label)
+            sys.exit(1)
+    
+    print "Names: %i" % count
+    print
+    print "%-24s %10s %10s %8s" % ("", "old (us)", "new (us)", "speedup")
+    
+    old = best_time(lambda: map(old_safe, names))
+    new = best_time(lambda: map(utilities._safe, names))
+    print "%-24s %10.3f %10.3f %8.2f" % (
+        "Decoding", old * 1000000 / count, new * 1000000 / count, old / new)
+    
+    for label, convert_dict in conversions:
+    
+        old = best_time(
+            lambda: map(lambda name: old_convert_name(name, convert_dict),
+                        safe_names)
+            )
+        new = best_time(
+            lambda: map(lambda name: utilities._convert_name(name,
+                                                             convert_dict),
+                        safe_names)
+            )
+        print "%-24s %10.3f %10.3f %8.2f" % (
+            "Converting (%s)" % label, old * 1000000 / count,
+            new * 1000000 / count, old / new)
+    
+    sys.exit()
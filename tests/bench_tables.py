@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""
+Times the creation of catalogue tables with ADFSdisc.catalogue_table for
+synthetic disc images, both as NumPy structured arrays and as dictionaries of
+array module columns, checking that both forms contain the same values. The
+NumPy form is skipped if NumPy is not installed.
+"""
+
+import sys, time
+
+# Importing ADFSlib should not import NumPy.
+import ADFSlib
+import make_images
+
+formats = ["ads", "adm", "adl", "adD", "adE", "adEbig"]
+
+
+def best_time(function, repeats = 5):
+
+    best = None
+    for i in range(repeats):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def same_values(array_table, plain_table):
+
+    # Return True if the structured array and the dictionary of columns
+    # contain the same values.
+    for field, typecode in ADFSlib.catalogue_columns:
+        if list(array_table[field]) != list(plain_table[field]):
+            return False
+    return True
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        files = int(sys.argv[1])
+    else:
+        files = 50
+    
+    if sys.modules.has_key("numpy"):
+        sys.stderr.write("Importing ADFSlib imported NumPy\n")
+        sys.exit(1)
+    
+    numpy = ADFSlib._import_numpy()
+    
+    if numpy is None:
+        print "NumPy is not installed; only timing the array module form."
+        print
+    
+    print "%-8s %8s %12s %12s" % ("format", "objects", "array (ms)",
+                                  "numpy (ms)")
+    
+    for disc_type in formats:
+    
+        data = make_images.make_image(disc_type, files, 3, 2)
+        disc = ADFSlib.ADFSdisc(ADFSlib.io.BytesIO(data))
+        
+        plain = disc.catalogue_table(use_numpy = 0)
+        plain_time = best_time(lambda: disc.catalogue_table(use_numpy = 0))
+        
+        if numpy is None:
+        
+            print "%-8s %8i %12.3f %12s" % (
+                disc_type, len(plain["path_id"]), plain_time * 1000, "-")
+            continue
+        
+        table = disc.catalogue_table()
+        
+        if not isinstance(table, numpy.ndarray) or \
+            not same_values(table, plain):
+            
+            sys.stderr.write("Tables differ for %s\n" % disc_type)
+            sys.exit(1)
+        
+        numpy_time = best_time(lambda: disc.catalogue_table())
+        
+        print "%-8s %8i %12.3f %12.3f" % (
+            disc_type, len(table), plain_time * 1000, numpy_time * 1000)
+    
+    sys.exit()
@@ -0,0 +1,638 @@
+#!/usr/bin/env python
+
+"""
+Generates synthetic ADFS disc images in the S, M, L, D, E and F formats with
+a configurable number of files, directory depth, fragmentation and number of
+defects, for use when testing and benchmarking ADFSlib.
+"""
+
+import random, struct, sys
+
+
+# Image geometry for each format: (length, sector size, tracks, sectors per
+# track).
+geometry = {"ads": (163840, 256, 40, 16),
+            "adm": (327680, 256, 80, 16),
+            "adl": (655360, 256, 160, 16),
+            "adD": (819200, 1024, 80, 10),
+            "adE": (819200, 1024, 80, 10),
+            "adEbig": (1638400, 1024, 80, 20)}
+
+# The maximum number of entries in old and new style directories.
+old_dir_entries = 47
+new_dir_entries = 77
+
+
+class Node:
+
+    def __init__(self, name, parent = None):
+    
+        self.name = name
+        self.parent = parent
+        self.files = []
+        self.address = 0
+        self.sin = 0
+
+
+class Leaf:
+
+    def __init__(self, name, data, load, exe):
+    
+        self.name = name
+        self.data = data
+        self.load = load
+        self.exe = exe
+        self.address = 0
+        self.sin = 0
+
+
+def _pad_name(name, size = 10):
+
+    name = name[:size]
+    if len(name) < size:
+        name = name + "\r"
+    return name + "\x00" * (size - len(name))
+
+
+def _num(size, n):
+
+    return "".join(map(lambda i: chr((n >> (i * 8)) & 0xff), range(size)))
+
+
+def _old_checksum(sector):
+
+    # Add the first 255 bytes in the sector from the end to the start,
+    # carrying as the 6502 ADC instruction does, starting with 255.
+    total = 255
+    carry = 0
+    for i in range(254, -1, -1):
+        total = total + ord(sector[i]) + carry
+        carry = total >> 8
+        total = total & 0xff
+    return total
+
+
+def _zone_check(zone):
+
+    v0 = v1 = v2 = v3 = 0
+    i = len(zone) - 4
+    while i > 0:
+        v0 = v0 + ord(zone[i]) + (v3 >> 8)
+        v3 = v3 & 0xff
+        v1 = v1 + ord(zone[i + 1]) + (v0 >> 8)
+        v0 = v0 & 0xff
+        v2 = v2 + ord(zone[i + 2]) + (v1 >> 8)
+        v1 = v1 & 0xff
+        v3 = v3 + ord(zone[i + 3]) + (v2 >> 8)
+        v2 = v2 & 0xff
+        i = i - 4
+    v0 = v0 + (v3 >> 8)
+    v1 = v1 + ord(zone[1]) + (v0 >> 8)
+    v2 = v2 + ord(zone[2]) + (v1 >> 8)
+    v3 = v3 + ord(zone[3]) + (v2 >> 8)
+    return (v0 ^ v1 ^ v2 ^ v3) & 0xff
+
+
+class ImageBuilder:
+
+    """builder = ImageBuilder(disc_type, files = 20, depth = 2,
+                              fragmentation = 0, defects = 0, seed = 0)
+    
+    Builds a synthetic disc image of the given type containing the requested
+    number of files spread over a directory tree of the given depth. For new
+    map formats, each file is split into up to fragmentation + 1 fragments
+    separated by free space, and the given number of defects are recorded in
+    the map. Call image() to obtain the contents of the disc image.
+    """
+    
+    def __init__(self, disc_type, files = 20, depth = 2, fragmentation = 0,
+                 defects = 0, seed = 0, max_length = 4096):
+        
+        self.disc_type = disc_type
+        self.length, self.sector_size, self.ntracks, self.nsectors = \
+            geometry[disc_type]
+        self.fragmentation = fragmentation
+        self.defects = defects
+        self.random = random.Random(seed)
+        self.max_length = max_length
+        
+        if disc_type in ("ads", "adm", "adl"):
+            self.capacity = old_dir_entries
+        else:
+            self.capacity = new_dir_entries
+        
+        self.root = Node("$")
+        self._make_tree(files, depth)
+    
+    def _make_tree(self, nfiles, depth):
+    
+        # Create a chain of directories for each level of depth, then spread
+        # the files over them.
+        directories = [self.root]
+        parent = self.root
+        for level in range(depth):
+            node = Node("Dir%i" % level, parent)
+            parent.files.append(node)
+            directories.append(node)
+            parent = node
+        
+        i = 0
+        while i < nfiles:
+            directory = directories[i % len(directories)]
+            if len(directory.files) >= self.capacity:
+                # Start a new directory in the root to hold more files.
+                directory = Node("More%i" % i, self.root)
+                self.root.files.append(directory)
+                directories.append(directory)
+            length = self.random.randint(0, self.max_length)
+            data = "".join(map(lambda j: chr(self.random.randint(0, 255)),
+                               range(length)))
+            load = 0xfffffd00 | self.random.randint(0, 255)
+            exe = self.random.randint(0, 0xffffffff)
+            directory.files.append(Leaf("File%i" % i, data, load, exe))
+            i = i + 1
+    
+    def _walk(self, node):
+    
+        yield node
+        for obj in node.files:
+            if isinstance(obj, Node):
+                for n in self._walk(obj):
+                    yield n
+            else:
+                yield obj
+    
+    def image(self):
+    
+        if self.disc_type in ("ads", "adm", "adl"):
+            return self._old_image()
+        elif self.disc_type == "adD":
+            return self._d_image()
+        else:
+            return self._new_image()
+    
+    # Old map formats (S, M, L and D)
+    
+    def _old_map(self, disc_sectors, free, unit):
+    
+        # The free space map occupies the first two 256 byte sectors.
+        starts = ""
+        lengths = ""
+        for start, length in free:
+            starts = starts + _num(3, start / unit)
+            lengths = lengths + _num(3, length / unit)
+        
+        name = _pad_name("Synthetic", 10).replace("\r", " ")
+        
+        s0 = starts + "\x00" * (0xf7 - len(starts)) + name[0::2] + \
+             _num(3, disc_sectors)
+        s0 = s0 + chr(_old_checksum(s0 + "\x00"))
+        s1 = lengths + "\x00" * (0xf6 - len(lengths)) + name[1::2] + \
+             _num(2, 0x1234) + "\x00" + chr(len(starts))
+        s1 = s1 + chr(_old_checksum(s1 + "\x00"))
+        return s0 + s1
+    
+    def _old_directory(self, node, title):
+    
+        # Old style directories are five 256 byte sectors long.
+        entries = ""
+        for obj in node.files:
+            if isinstance(obj, Node):
+                # Set the R and D attributes.
+                name = _pad_name(obj.name)
+                name = chr(ord(name[0]) | 0x80) + name[1:3] + \
+                       chr(ord(name[3]) | 0x80) + name[4:]
+                entries = entries + name + _num(4, 0) + _num(4, 0) + \
+                          _num(4, 0x500) + _num(3, obj.address / 256) + "\x00"
+            else:
+                # Set the R and W attributes.
+                name = _pad_name(obj.name)
+                name = chr(ord(name[0]) | 0x80) + chr(ord(name[1]) | 0x80) + \
+                       name[2:]
+                entries = entries + name + _num(4, obj.load) + \
+                          _num(4, obj.exe) + _num(4, len(obj.data)) + \
+                          _num(3, obj.address / 256) + "\x00"
+        
+        head = "\x01Hugo" + entries
+        head = head + "\x00" * (0x4cc - len(head))
+        
+        if node.parent is None:
+            parent = node.address
+        else:
+            parent = node.parent.address
+        
+        tail = _pad_name(node.name) + _num(3, parent / 256) + \
+               _pad_name(title, 19) + "\x00" * 14 + "\x01Hugo\x00"
+        return head + tail
+    
+    def _old_image(self):
+    
+        unit = 256
+        image = ["\x00"] * self.length
+        
+        # Allocate space for each directory and file after the map.
+        address = 0x200
+        for obj in self._walk(self.root):
+            obj.address = address
+            if isinstance(obj, Node):
+                address = address + 0x500
+            else:
+                if len(obj.data) == 0x500:
+                    # Avoid lengths that would look like directories.
+                    obj.data = obj.data[:-1]
+                address = address + ((len(obj.data) + unit - 1) / unit) * unit
+            if self.fragmentation:
+                address = address + unit * self.fragmentation
+        
+        if address > self.length:
+            raise ValueError, "Too much data for this disc format."
+        
+        for obj in self._walk(self.root):
+            if isinstance(obj, Node):
+                data = self._old_directory(obj, "Synthetic")
+            else:
+                data = obj.data
+            image[obj.address:obj.address + len(data)] = list(data)
+        
+        free = self._old_free_space(address, unit)
+        image[:0x200] = list(self._old_map(self.length / unit, free, unit))
+        image = "".join(image)
+        
+        if self.disc_type == "adl":
+            image = self._interleave(image)
+        
+        return image
+    
+    def _old_free_space(self, end, unit):
+    
+        free = []
+        if self.fragmentation:
+            for obj in self._walk(self.root):
+                if isinstance(obj, Node):
+                    used = 0x500
+                else:
+                    used = ((len(obj.data) + unit - 1) / unit) * unit
+                free.append((obj.address + used, unit * self.fragmentation))
+        if end < self.length:
+            free.append((end, self.length - end))
+        return free[:82]
+    
+    def _interleave(self, image):
+    
+        # Store the logical tracks (0 1 2 ... 159) in the order used by
+        # interleaved L format images (0 80 1 81 ... 79 159).
+        track_size = self.nsectors * self.sector_size
+        half = self.ntracks / 2
+        tracks = []
+        for i in range(half):
+            tracks.append(image[i * track_size:(i + 1) * track_size])
+            tracks.append(image[(i + half) * track_size:(i + half + 1) * track_size])
+        return "".join(tracks)
+    
+    def _new_directory(self, node, marker, parent_address):
+    
+        # New style directories are 2048 bytes long.
+        entries = ""
+        for obj in node.files:
+            if isinstance(obj, Node):
+                entries = entries + _pad_name(obj.name) + _num(4, 0) + \
+                          _num(4, 0) + _num(4, 0x800) + _num(3, obj.sin) + \
+                          "\x0b"
+            else:
+                entries = entries + _pad_name(obj.name) + _num(4, obj.load) + \
+                          _num(4, obj.exe) + _num(4, len(obj.data)) + \
+                          _num(3, obj.sin) + "\x03"
+        
+        head = "\x01" + marker + entries
+        head = head + "\x00" * (2048 - 41 - len(head))
+        
+        tail = "\x00" * 3 + _num(3, parent_address) + \
+               _pad_name("Synthetic", 19) + _pad_name(node.name) + \
+               "\x01" + marker + "\x00"
+        return head + tail
+    
+    def _d_image(self):
+    
+        unit = 1024
+        image = ["\x00"] * self.length
+        
+        address = 0x400
+        for obj in self._walk(self.root):
+            obj.address = address
+            if isinstance(obj, Node):
+                address = address + 0x800
+            else:
+                address = address + ((len(obj.data) + unit - 1) / unit) * unit
+            if self.fragmentation:
+                address = address + unit * self.fragmentation
+        
+        if address > self.length:
+            raise ValueError, "Too much data for this disc format."
+        
+        for obj in self._walk(self.root):
+            obj.sin = obj.address / 256
+        
+        for obj in self._walk(self.root):
+            if isinstance(obj, Node):
+                if obj.parent is None:
+                    parent = obj.sin
+                else:
+                    parent = obj.parent.sin
+                data = self._new_directory(obj, "Hugo", parent)
+            else:
+                data = obj.data
+            image[obj.address:obj.address + len(data)] = list(data)
+        
+        free = self._old_free_space(address, unit)
+        image[:0x200] = list(self._old_map(self.length / 256, free, 256))
+        return "".join(image)
+    
+    # New map formats (E and F)
+    
+    def _new_layout(self):
+    
+        if self.disc_type == "adE":
+            self.log2bpmb = 7
+            self.zones = 1
+            self.zone_spare = 0
+            self.map_address = 0
+            self.root_address = 0x800
+        else:
+            self.log2bpmb = 6
+            self.zones = 4
+            self.zone_spare = 1600
+            self.map_address = 0xc6800
+            self.root_address = 0xc8800
+        
+        self.idlen = 15
+        self.zone_bits = self.sector_size * 8 - self.zone_spare
+        self.ids_per_zone = self.zone_bits / (self.idlen + 1)
+        
+        # Allocation units are map bytes, which are 8 map bits.
+        self.unit = 8 << self.log2bpmb
+        total = self.length / self.unit
+        
+        # The ranges of allocation units covered by each zone.
+        self.zone_ranges = []
+        for zone in range(self.zones):
+            if zone == 0:
+                start = 0
+            else:
+                start = (zone * self.zone_bits - 480) / 8
+            end = ((zone + 1) * self.zone_bits - 480) / 8
+            self.zone_ranges.append((start, min(end, total)))
+        
+        # Object 2 contains the map (and its copy) and the root directory.
+        self.reserved = (self.map_address / self.unit,
+                         (self.root_address + 2048) / self.unit)
+    
+    def _zone_for_unit(self, unit):
+    
+        for zone in range(self.zones):
+            start, end = self.zone_ranges[zone]
+            if start <= unit < end:
+                return zone
+        raise ValueError, "Unit %i is beyond the end of the disc." % unit
+    
+    def _limit(self, unit):
+    
+        # Return the first unit at or beyond the given one at which the
+        # current fragment must stop.
+        limit = self.zone_ranges[self._zone_for_unit(unit)][1]
+        if unit < self.reserved[0]:
+            limit = min(limit, self.reserved[0])
+        return limit
+    
+    def _skip(self, unit):
+    
+        if self.reserved[0] <= unit < self.reserved[1]:
+            unit = self.reserved[1]
+        if unit == self._limit(unit) and unit < self.zone_ranges[-1][1]:
+            # Not expected, but handle it anyway.
+            unit = unit + 1
+        return unit
+    
+    def _allocate(self, size, fragments):
+    
+        # Returns a list of (start, end) pairs of allocation units.
+        pieces = []
+        remaining = max(2, (size + self.unit - 1) / self.unit)
+        piece_size = max(2, (remaining + fragments - 1) / fragments)
+        
+        while remaining > 0:
+        
+            self.cursor = self._skip(self.cursor)
+            limit = self._limit(self.cursor)
+            available = limit - self.cursor
+            
+            n = max(2, min(piece_size, remaining))
+            if n > available:
+                n = available
+            if available - n == 1:
+                n = available
+            if n < 2:
+                raise ValueError, "Too much data for this disc format."
+            
+            pieces.append((self.cursor, self.cursor + n))
+            self.cursor = self.cursor + n
+            remaining = remaining - n
+            
+            if remaining > 0 and self.fragmentation:
+                # Leave a gap of free space between fragments.
+                available = limit - self.cursor
+                if available == 2 or available >= 4:
+                    self.cursor = self.cursor + 2
+        
+        return pieces
+    
+    def _zone_of_id(self, zone):
+    
+        # Return an unused fragment ID for the given zone.
+        ids = self.next_ids.get(zone, max(3, zone * self.ids_per_zone))
+        self.next_ids[zone] = ids + 1
+        return ids
+    
+    def _new_image(self):
+    
+        self._new_layout()
+        image = ["\x00"] * self.length
+        
+        # Each fragment is recorded as (start unit, end unit, fragment id).
+        fragments = [self.reserved + (2,)]
+        self.cursor = 0
+        self.next_ids = {}
+        
+        defects = self.defects
+        
+        for obj in self._walk(self.root):
+            if obj is self.root:
+                obj.address = self.root_address
+                obj.sin = 0x200 | (1 + (self.root_address - self.map_address) / self.sector_size)
+                continue
+            
+            if isinstance(obj, Node):
+                # Directories are not fragmented.
+                size = 2048
+                pieces = self._allocate(size, 1)
+            else:
+                size = len(obj.data)
+                if size == 0:
+                    obj.sin = 0
+                    continue
+                pieces = self._allocate(size, self.fragmentation + 1)
+            
+            frag_id = self._zone_of_id(self._zone_for_unit(pieces[0][0]))
+            obj.sin = (frag_id << 8) | 1
+            obj.address = pieces[0][0] * self.unit
+            obj.pieces = pieces
+            for start, end in pieces:
+                fragments.append((start, end, frag_id))
+            
+            if defects > 0:
+                self.cursor = self._skip(self.cursor)
+                if self._limit(self.cursor) - self.cursor in (2, 3) or \
+                   self._limit(self.cursor) - self.cursor >= 4:
+                    n = 2
+                    if self._limit(self.cursor) - self.cursor == 3:
+                        n = 3
+                    fragments.append((self.cursor, self.cursor + n, 1))
+                    self.cursor = self.cursor + n
+                    defects = defects - 1
+        
+        # Write the contents of files and directories.
+        for obj in self._walk(self.root):
+            if isinstance(obj, Node):
+                if obj.parent is None:
+                    parent = obj.sin
+                else:
+                    parent = obj.parent.sin
+                data = self._new_directory(obj, "Nick", parent)
+            else:
+                data = obj.data
+            
+            if obj is self.root:
+                image[obj.address:obj.address + len(data)] = list(data)
+            elif data:
+                for start, end in obj.pieces:
+                    piece = data[:(end - start) * self.unit]
+                    data = data[len(piece):]
+                    a = start * self.unit
+                    image[a:a + len(piece)] = list(piece)
+        
+        map_data = self._map(fragments)
+        a = self.map_address
+        image[a:a + len(map_data)] = list(map_data)
+        a = a + len(map_data)
+        image[a:a + len(map_data)] = list(map_data)
+        return "".join(image)
+    
+    def _disc_record(self):
+    
+        if self.disc_type == "adE":
+            sectors, heads, density = 5, 2, 2
+        else:
+            sectors, heads, density = 10, 2, 3
+        
+        return struct.pack("<BBBBBBBBBBHI", 10, sectors, heads, density,
+                           self.idlen, self.log2bpmb, 1, 0, 0, self.zones,
+                           self.zone_spare,
+                           0x200 | (1 + (self.root_address - self.map_address) / self.sector_size)) + \
+               struct.pack("<IH", self.length, 0x1234) + \
+               _pad_name("Synthetic").replace("\r", " ").replace("\x00", " ") + \
+               "\x00" * 28
+    
+    def _map(self, fragments):
+    
+        fragments.sort()
+        zones = []
+        
+        for zone in range(self.zones):
+        
+            data = ["\x00"] * self.sector_size
+            start, end = self.zone_ranges[zone]
+            
+            if zone == 0:
+                record = self._disc_record()
+                data[4:4 + len(record)] = list(record)
+                offset = 64
+            else:
+                offset = 4
+            
+            # Find the fragments in this zone and fill the gaps with free
+            # space.
+            pieces = []
+            unit = start
+            for frag_start, frag_end, frag_id in fragments:
+                if frag_start < start or frag_start >= end:
+                    continue
+                if frag_start > unit:
+                    pieces.append((unit, frag_start, None))
+                pieces.append((frag_start, frag_end, frag_id))
+                unit = frag_end
+            if unit < end:
+                pieces.append((unit, end, None))
+            
+            free = filter(lambda p: p[2] is None, pieces)
+            links = {}
+            previous = None
+            for piece in free:
+                position = (piece[0] - start + offset) * 8
+                if previous is None:
+                    link = position - 8
+                    data[1:3] = list(_num(2, link | 0x8000))
+                else:
+                    links[previous] = position - previous[1]
+                previous = (piece, position)
+            
+            for piece in pieces:
+                frag_start, frag_end, frag_id = piece
+                a = frag_start - start + offset
+                if frag_id is None:
+                    position = a * 8
+                    frag_id = 0
+                    for key, value in links.items():
+                        if key[0] == piece:
+                            frag_id = value
+                if frag_end - frag_start == 2:
+                    frag_id = frag_id | 0x8000
+                else:
+                    data[frag_end - start + offset - 1] = "\x80"
+                data[a:a + 2] = list(_num(2, frag_id))
+            
+            zones.append(data)
+        
+        # Make the cross check bytes of all zones combine to give 0xff.
+        zones[-1][3] = "\xff"
+        
+        map_data = ""
+        for data in zones:
+            data = "".join(data)
+            map_data = map_data + chr(_zone_check(data)) + data[1:]
+        
+        return map_data
+
+
+def make_image(disc_type, files = 20, depth = 2, fragmentation = 0,
+               defects = 0, seed = 0):
+    
+    """Returns a string containing a synthetic disc image of the given type
+    ("ads", "adm", "adl", "adD", "adE" or "adEbig")."""
+    
+    builder = ImageBuilder(disc_type, files, depth, fragmentation, defects,
+                           seed)
+    return builder.image()
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 3:
+    
+        sys.stderr.write(
+            "Usage: %s <format> <output file> [files [depth [fragmentation "
+            "[defects]]]]\n" % sys.argv[0]
+            )
+        sys.exit(1)
+    
+    args = map(int, sys.argv[3:])
+    open(sys.argv[2], "wb").write(make_image(sys.argv[1], *args))
+    sys.exit()
@@ -16,10 +16,13 @@ if __name__ == "__main__":
     
         if os.path.isfile(path):
         
-            try:
-                d = ADFSlib.ADFSdisc(open(path))
-                print path, d.disc_format()
-            except ADFSlib.ADFS_exception:
+            # Only read the parts of the image needed to identify it.
+            disc_type, disc_name, confidence = ADFSlib.probe(path)
+            
+            if disc_type is None:
                 sys.stderr.write("Unrecognised file: %s\n" % path)
+            else:
+                print path, ADFSlib.ADFSdisc._format_names[disc_type], \
+                      "(%s, %i%%)" % (disc_name, confidence * 100)
     
     sys.exit()